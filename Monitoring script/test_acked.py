@@ -0,0 +1,141 @@
+import json
+
+import pytest
+
+import vm_agent
+from vm_agent import AckedRanges, Spool
+
+
+# --- Acknowledged Ranges ---
+def ranges(acked, boot_id="boot"):
+    return acked._ranges.get(boot_id, [])
+
+
+def test_adjacent_sequence_numbers_merge_into_one_range():
+    acked = AckedRanges()
+    for seq in (1, 2, 3):
+        acked.add("boot", seq)
+    assert ranges(acked) == [[1, 3]]
+    assert acked.summary() == {"ranges": 1, "records": 3}
+
+
+def test_out_of_order_sequence_numbers_fill_gaps():
+    acked = AckedRanges()
+    for seq in (5, 1, 3, 9):
+        acked.add("boot", seq)
+    assert ranges(acked) == [[1, 1], [3, 3], [5, 5], [9, 9]]
+    acked.add("boot", 4)  # joins the ranges on both sides
+    assert ranges(acked) == [[1, 1], [3, 5], [9, 9]]
+    acked.add("boot", 2)
+    acked.add("boot", 8)  # extends a range downwards
+    assert ranges(acked) == [[1, 5], [8, 9]]
+    acked.add("boot", 3)  # already covered
+    assert ranges(acked) == [[1, 5], [8, 9]]
+    assert [seq for seq in range(11) if acked.contains("boot", seq)] == [1, 2, 3, 4, 5, 8, 9]
+
+
+def test_boots_are_kept_apart():
+    acked = AckedRanges()
+    acked.add("old", 1)
+    acked.add("new", 2)
+    assert not acked.contains("new", 1)
+    assert not acked.contains("old", 2)
+    assert not acked.contains("old", None)
+    assert acked.summary() == {"ranges": 2, "records": 2}
+
+
+# --- Resends ---
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.text = ""
+
+
+class FakeTransport:
+    # Answers each request with the next status in statuses, then 201.
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.calls = []
+
+    def request(self, method, url, headers=None, data=None, **kwargs):
+        self.calls.append((url, json.loads(data.decode("utf-8"))))
+        return FakeResponse(self.statuses.pop(0) if self.statuses else 201)
+
+    def close(self):
+        pass
+
+
+class SimClock:
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def wait(self, event, timeout):
+        self.now += timeout
+        return event.is_set()
+
+
+def record(seq, boot_id="boot"):
+    return {"vmId": "vm-1", "bootId": boot_id, "seq": seq, "resolution": "1m", "avgCpu": 10.0}
+
+
+def sent_seqs(call):
+    url, body = call
+    return [r["seq"] for r in body["records"]] if url == vm_agent.PERFORMANCE_BULK_URL else [body["seq"]]
+
+
+@pytest.fixture
+def agent(tmp_path):
+    agent = vm_agent.Agent("user@example.com", "token", agent_id="vm-1", collectors=[],
+                           transport=FakeTransport(), clock=SimClock(), spool_dir=str(tmp_path))
+    agent.encoder = vm_agent.PayloadEncoder(algorithm=None, wire_format="json")
+    agent.spool = Spool(str(tmp_path), agent.clock)
+    yield agent
+    agent.spool.close()
+
+
+def test_acknowledged_records_are_not_resent(agent):
+    agent.acked.add("boot", 1)
+    agent.acked.add("boot", 3)
+    assert agent.send_performance([record(1), record(2), record(3), record(4)])
+    assert [sent_seqs(call) for call in agent.transport.calls] == [[2, 4]]
+    # Everything is acknowledged now, so a resend makes no request at all.
+    assert agent.send_performance([record(1), record(2), record(3), record(4)])
+    assert len(agent.transport.calls) == 1
+
+
+def test_a_resend_for_another_boot_is_not_filtered(agent):
+    agent.acked.add("old", 1)
+    assert agent.send_performance([record(1, boot_id="new")])
+    assert [sent_seqs(call) for call in agent.transport.calls] == [[1]]
+
+
+def test_failed_send_acknowledges_nothing(agent):
+    agent.transport.statuses = [503]
+    assert not agent.send_performance([record(1), record(2)])
+    assert agent.acked.summary() == {"ranges": 0, "records": 0}
+
+
+def test_replay_skips_the_part_of_a_batch_already_stored(agent, monkeypatch):
+    monkeypatch.setattr(vm_agent, "PERFORMANCE_BATCH_SIZE", 2)
+    agent.spool.append_batch("performance", [record(seq) for seq in range(1, 6)])
+    # The first batch is stored, then the backend goes away mid-segment.
+    agent.transport.statuses = [201, 503]
+    agent._replay_next_segment({})
+    assert [sent_seqs(call) for call in agent.transport.calls] == [[1, 2], [3, 4]]
+    assert agent.spool.oldest_segment() is not None
+    # Replayed from the top (the saved position is lost, as after an error),
+    # only what the backend has not acknowledged goes out again.
+    agent.backoffs["performance"].record_success()
+    agent.breaker.record_success()
+    agent.transport.calls.clear()
+    agent._replay_next_segment({})
+    assert [sent_seqs(call) for call in agent.transport.calls] == [[3, 4], [5]]
+    assert agent.spool.oldest_segment() is None
+    assert agent.acked.summary() == {"ranges": 1, "records": 5}
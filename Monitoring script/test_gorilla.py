@@ -0,0 +1,205 @@
+import math
+import struct
+
+import pytest
+
+import vm_agent
+from vm_agent import BitReader, BitWriter, Spool, decode_columns, encode_columns
+
+
+def float_bits(value):
+    return struct.unpack("<Q", struct.pack("<d", value))[0]
+
+
+def bits_float(bits):
+    return struct.unpack("<d", struct.pack("<Q", bits))[0]
+
+
+def round_trip_floats(values):
+    writer = BitWriter()
+    vm_agent._encode_floats(writer, values)
+    return vm_agent._decode_floats(BitReader(writer.getvalue()), len(values))
+
+
+def round_trip_integers(values):
+    writer = BitWriter()
+    vm_agent._encode_integers(writer, values)
+    return vm_agent._decode_integers(BitReader(writer.getvalue()), len(values))
+
+
+# --- Floats ---
+# Compared bit for bit, so NaN payloads and the sign of zero count too.
+FLOAT_CASES = {
+    "nan": [1.0, math.nan, math.nan, 2.0, bits_float(0x7FF8000000000001)],
+    "signed zero": [0.0, -0.0, 0.0, -0.0, 1.5, -0.0],
+    "infinity": [math.inf, -math.inf, 42.0, math.inf, math.inf],
+    "subnormals": [5e-324, -5e-324, 2.2250738585072009e-308, 1e-310, 0.0],
+    "extremes": [1.7976931348623157e308, -1.7976931348623157e308, 2.2250738585072014e-308],
+    "constant": [12.5] * 10,
+    "percentages": [12.5, 12.6, 12.4, 13.0, 99.9, 0.1, 50.0, 50.05],
+    # XOR of these has its top and bottom bits set: 64 meaningful bits,
+    # which the 6-bit length field stores as 0.
+    "64 meaningful bits": [0.0, bits_float(0x8000000000000001), 0.0, bits_float(0xFFFFFFFFFFFFFFFF)],
+}
+
+
+@pytest.mark.parametrize("values", FLOAT_CASES.values(), ids=list(FLOAT_CASES))
+def test_floats_round_trip_bit_exact(values):
+    decoded = round_trip_floats(values)
+    assert [float_bits(value) for value in decoded] == [float_bits(value) for value in values]
+
+
+def test_single_float():
+    assert float_bits(round_trip_floats([-0.0])[0]) == float_bits(-0.0)
+
+
+# --- Integers ---
+def steps(*dods):
+    # Integer column whose delta-of-deltas are exactly dods.
+    values, delta = [1000], 0
+    for dod in dods:
+        delta += dod
+        values.append(values[-1] + delta)
+    return values
+
+
+# The edges of each delta-of-delta bucket (7, 9 and 12 value bits) and the
+# step just past it, which has to go to the next bucket.
+BUCKET_EDGES = [0, 1, -1, 63, -64, 64, -65, 255, -256, 256, -257, 2047, -2048, 2048, -2049]
+
+
+@pytest.mark.parametrize("dod", BUCKET_EDGES)
+def test_integer_bucket_boundaries(dod):
+    values = steps(dod, -dod, dod, 0)
+    assert round_trip_integers(values) == values
+
+
+def test_integer_bucket_sizes():
+    # 64-bit first value, then one bit for a zero step and 2+7, 3+9, 4+12 and
+    # 4+64 bits for steps just inside each bucket.
+    for dod, bits in ((0, 1), (63, 9), (-64, 9), (64, 12), (255, 12), (-256, 12),
+                      (256, 16), (2047, 16), (-2048, 16), (2048, 68), (-2049, 68)):
+        writer = BitWriter()
+        vm_agent._encode_integers(writer, [0, dod])
+        assert len(writer.getvalue()) == math.ceil((64 + bits) / 8), dod
+
+
+@pytest.mark.parametrize("values", [
+    [0, 1 << 40, 1 << 41, -(1 << 50), 1 << 62, 1 << 62],
+    [0, (1 << 63) - 1],  # largest step
+    [0, -(1 << 63)],     # smallest step
+    [-(1 << 63), -1],
+], ids=["large steps", "max step", "min step", "min value"])
+def test_integer_full_64_bit_escape(values):
+    assert round_trip_integers(values) == values
+
+
+def test_integer_out_of_range():
+    with pytest.raises(ValueError):
+        round_trip_integers([0, 1 << 63])
+    with pytest.raises(ValueError):
+        # Each value fits, but the step between them needs 65 bits.
+        round_trip_integers([0, (1 << 63) - 1, -(1 << 63)])
+
+
+def test_regular_timestamps_cost_one_bit_each():
+    values = list(range(1700000000000, 1700000000000 + 60000 * 1000, 60000))
+    writer = BitWriter()
+    vm_agent._encode_integers(writer, values)
+    # First value, first delta (12-bit bucket is too small), then zero dods.
+    assert len(writer.getvalue()) <= (64 + 68 + len(values) - 2 + 7) // 8
+    assert round_trip_integers(values) == values
+
+
+# --- Blocks ---
+def test_block_round_trip_with_strings_and_timestamps():
+    rows = [
+        {"vmId": "vm-1", "resolution": "1m", "seq": i, "avgCpu": 10.0 + i / 3,
+         "timestamp": vm_agent.format_timestamp(1700000000 + 60 * i)}
+        for i in range(50)
+    ]
+    rows[10]["resolution"] = "5m"  # breaks the run
+    decoded, meta = decode_columns(encode_columns(rows, {"kind": "performance"}))
+    assert meta == {"kind": "performance"}
+    assert decoded == rows
+
+
+def test_timestamps_are_kept_to_the_millisecond():
+    rows = [{"timestamp": "2023-11-14T22:13:20.123456Z"},
+            {"timestamp": "2023-11-14T22:13:21Z"},
+            {"timestamp": "2023-11-14T22:13:22.999000Z"}]
+    decoded, _ = decode_columns(encode_columns(rows))
+    assert [row["timestamp"] for row in decoded] == [
+        "2023-11-14T22:13:20.123000Z", "2023-11-14T22:13:21Z", "2023-11-14T22:13:22.999000Z"]
+
+
+def test_timestamp_named_field_only():
+    # Other string columns are stored verbatim, however much they look like times.
+    rows = [{"at": "2023-11-14T22:13:20.123456Z"}]
+    assert decode_columns(encode_columns(rows))[0] == rows
+
+
+def test_mixed_int_and_float_column_decodes_as_floats():
+    decoded, _ = decode_columns(encode_columns([{"v": 1}, {"v": 2.5}]))
+    assert decoded == [{"v": 1.0}, {"v": 2.5}]
+    assert type(decoded[0]["v"]) is float
+
+
+@pytest.mark.parametrize("rows", [
+    [{"a": 1}, {"b": 1}],
+    [{"a": 1}, {"a": 2, "b": 3}],
+    [{"a": 1, "b": 2}, {"a": 1}],
+], ids=["different keys", "extra key", "missing key"])
+def test_mixed_key_sets_are_rejected(rows):
+    with pytest.raises(ValueError):
+        encode_columns(rows)
+
+
+@pytest.mark.parametrize("rows", [
+    [],
+    [{"a": None}],
+    [{"a": {"nested": 1}}],
+    [{"a": "x"}, {"a": 1}],
+    [{"a": True}],
+], ids=["empty", "null", "nested", "str and int", "bool"])
+def test_unencodable_rows_are_rejected(rows):
+    with pytest.raises(ValueError):
+        encode_columns(rows)
+
+
+def test_truncated_block():
+    data = encode_columns([{"a": float(i) * 1.1} for i in range(20)])
+    with pytest.raises(ValueError):
+        decode_columns(data[:-4])
+
+
+# --- Spool ---
+def test_spool_reads_back_mixed_gorilla_and_json_frames(tmp_path):
+    spool = Spool(str(tmp_path))
+    records = [
+        {"vmId": "vm-1", "seq": 1, "avgCpu": 1.5, "timestamp": "2023-11-14T22:13:00Z"},
+        {"vmId": "vm-1", "seq": 2, "avgCpu": math.inf, "timestamp": "2023-11-14T22:14:00Z"},
+        {"vmId": "vm-1", "seq": 3, "avgCpu": None},  # new key set with no encoding: JSON
+        {"vmId": "vm-1", "seq": 4, "timestamp": "2023-11-14T22:16:00Z"},  # another key set
+        {"vmId": "vm-1", "seq": 5, "timestamp": "2023-11-14T22:17:00Z"},
+    ]
+    spool.append_batch("performance", records[:3])
+    spool.append("other", {"note": "plain"})
+    spool.append_batch("performance", records[3:])
+    segment_id = spool.oldest_segment()
+    read = spool.read_segment(segment_id)
+    spool.close()
+    assert read == [("performance", record) for record in records[:3]] + [
+        ("other", {"note": "plain"})] + [("performance", record) for record in records[3:]]
+    with open(spool._path(segment_id), "rb") as f:
+        assert f.read().count(vm_agent.GORILLA_MAGIC) == 2
+
+
+def test_spool_skips_an_undecodable_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append_batch("performance", [{"a": 1.0}, {"a": 2.0}])
+    spool._write(vm_agent.GORILLA_MAGIC + b"garbage")  # checksum is valid, content is not
+    spool.append("performance", {"a": 3.0})
+    read = spool.read_segment(spool.oldest_segment())
+    spool.close()
+    assert read == [("performance", {"a": 1.0}), ("performance", {"a": 2.0}), ("performance", {"a": 3.0})]
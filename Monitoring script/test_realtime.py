@@ -0,0 +1,253 @@
+import copy
+import json
+
+import pytest
+
+import vm_agent
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.text = ""
+
+
+class FakeTransport:
+    def __init__(self):
+        self.calls = []
+
+    def request(self, method, url, headers=None, data=None, **kwargs):
+        self.calls.append((method, json.loads(data.decode("utf-8")) if data else None))
+        return FakeResponse(200 if method == "PUT" else 204)
+
+    def close(self):
+        pass
+
+
+class FakeStream:
+    # Acknowledges everything sent by the next poll unless acking is off;
+    # closed_by_server makes the next poll fail the way a close frame does.
+    def __init__(self):
+        self.conn = False
+        self.sent = []
+        self.acking = True
+        self.closed_by_server = None
+
+    def connected(self):
+        return self.conn
+
+    def connect(self, token, hello):
+        self.conn = True
+        return 0
+
+    def poll(self):
+        if self.closed_by_server:
+            raise ConnectionError(self.closed_by_server)
+        if self.acking and self.sent:
+            return self.sent[-1]
+        return None
+
+    def send(self, seq, sample):
+        self.sent.append(seq)
+
+    def close(self):
+        self.conn = False
+
+
+def base_sample():
+    return {
+        "cpu": 10.0, "memory": 20.0, "disk": 30.0,
+        "cpu_breakdown": {"user": 5.0, "system": 3.0, "iowait": 1.0, "irq": 0.5, "softirq": 0.5,
+                          "steal": 0.0, "per_core": [10.0, 10.0], "max_core": 10.0},
+        "load_avg": [0.5, 0.4, 0.3],
+        "cpu_activity": {"ctx_switches": 5000.0, "interrupts": 2000.0, "soft_interrupts": 800.0},
+        "network": {"bytes_sent": 1000, "bytes_recv": 2000, "packets_sent": 10, "packets_recv": 20,
+                    "bytes_sent_per_sec": 100.0, "bytes_recv_per_sec": 200.0,
+                    "interfaces": [{"name": "eth0", "bytes_sent_per_sec": 100.0, "bytes_recv_per_sec": 200.0}]},
+        "disk_io": {"read_bytes_per_sec": 0.0, "write_bytes_per_sec": 0.0, "iops": 0.0,
+                    "await_ms": 0.0, "queue_depth": 0.0,
+                    "devices": [{"device": "sda", "read_bytes_per_sec": 0.0, "write_bytes_per_sec": 0.0,
+                                 "read_iops": 0.0, "write_iops": 0.0}]},
+        "filesystems": [{"mount": "/mnt/nfs", "device": "srv:/export", "fstype": "nfs4",
+                         "hung": False, "percent": 10.0}],
+        "tcp": {"states": {"ESTABLISHED": 1000, "TIME_WAIT": 200, "LISTEN": 4},
+                "listen_overflows": 0, "listen_drops": 0},
+    }
+
+
+@pytest.fixture
+def agent(tmp_path):
+    current = base_sample()
+    stream = FakeStream()
+    transport = FakeTransport()
+    agent = vm_agent.Agent("user@example.com", "token", agent_id="vm-1",
+                           collectors=[lambda: copy.deepcopy(current)],
+                           transport=transport, spool_dir=str(tmp_path), stream=stream)
+    agent.encoder = vm_agent.PayloadEncoder(algorithm=None)
+    agent.current = current
+
+    def tick():
+        agent.sample_metrics(0.0)
+        agent.update_realtime(0.0)
+    agent.tick = tick
+    tick()  # registers with a full PUT
+    tick()  # connects the stream
+    assert [method for method, _ in transport.calls] == ["PUT"]
+    assert stream.connected()
+    return agent
+
+
+def patches(agent):
+    return [body for method, body in agent.transport.calls if method == "PATCH"]
+
+
+def test_streaming_sends_nothing_by_http_when_only_streamed_fields_move(agent):
+    agent.current["cpu"] = 95.0
+    agent.current["network"]["bytes_sent"] += 10 ** 9
+    for _ in range(5):
+        agent.tick()
+    assert patches(agent) == []
+    assert len(agent.stream.sent) == 7
+
+
+def test_registration_carries_cpu_breakdown(agent):
+    put = agent.transport.calls[0][1]
+    assert put["cpu_breakdown"]["per_core"] == [10.0, 10.0]
+    assert put["load_avg"] == [0.5, 0.4, 0.3]
+    assert put["cpu_activity"]["ctx_switches"] == 5000.0
+
+
+def test_streaming_still_patches_cpu_breakdown(agent):
+    agent.current["cpu_breakdown"].update(steal=25.0)
+    agent.tick()
+    agent.current["cpu_breakdown"].update(per_core=[100.0, 10.0], max_core=100.0)
+    agent.tick()
+    agent.current["load_avg"] = [4.0, 1.0, 0.5]
+    agent.current["cpu_activity"]["ctx_switches"] = 5100.0  # within the deadband
+    agent.tick()
+    agent.current["cpu_activity"]["ctx_switches"] = 50000.0
+    agent.tick()
+    sent = patches(agent)
+    assert [sorted(body) for body in sent] == [
+        ["cpu_breakdown", "last_updated"], ["cpu_breakdown", "last_updated"],
+        ["last_updated", "load_avg"], ["cpu_activity", "last_updated"]]
+    assert sent[0]["cpu_breakdown"]["steal"] == 25.0
+    assert sent[1]["cpu_breakdown"]["max_core"] == 100.0
+
+
+def test_streaming_still_patches_filesystems(agent):
+    agent.current["filesystems"][0]["hung"] = True
+    agent.tick()
+    agent.current["filesystems"][0].update(hung=False, percent=60.0)
+    agent.tick()
+    agent.tick()
+    assert [body["filesystems"][0]["hung"] for body in patches(agent)] == [True, False]
+    assert patches(agent)[-1]["filesystems"][0]["percent"] == 60.0
+    assert "cpu" not in patches(agent)[0]
+
+
+def test_streaming_still_patches_interfaces_and_devices(agent):
+    agent.current["network"]["interfaces"].append(
+        {"name": "eth1", "bytes_sent_per_sec": 0.0, "bytes_recv_per_sec": 0.0})
+    agent.tick()
+    agent.tick()  # baseline kept: nothing moved since
+    agent.current["disk_io"]["devices"][0]["write_iops"] = 500.0
+    agent.tick()
+    sent = patches(agent)
+    assert len(sent) == 2
+    assert [nic["name"] for nic in sent[0]["network"]["interfaces"]] == ["eth0", "eth1"]
+    assert sent[1]["disk_io"]["devices"][0]["write_iops"] == 500.0
+
+
+def test_streaming_still_patches_tcp(agent):
+    agent.current["tcp"]["states"]["ESTABLISHED"] = 6000
+    agent.tick()
+    within_deadband = 6000 + vm_agent.TCP_DEADBAND_SOCKETS - 1
+    agent.current["tcp"]["states"]["ESTABLISHED"] = within_deadband
+    agent.tick()
+    agent.current["tcp"].update(listen_overflows=1, listen_drops=1)
+    agent.tick()
+    sent = patches(agent)
+    assert [body["tcp"]["states"]["ESTABLISHED"] for body in sent] == [6000, within_deadband]
+    assert sent[1]["tcp"]["listen_overflows"] == 1
+
+
+def test_http_fallback_keeps_heartbeat(agent):
+    agent.stream.close()
+    agent.backoffs["stream"].record_failure(retry_after=60)
+    agent._realtime_sent_time -= vm_agent.REALTIME_HEARTBEAT_INTERVAL
+    agent.tick()
+    assert list(patches(agent)[-1]) == ["last_updated"]
+
+
+def test_unacknowledged_stream_falls_back_to_http(agent, monkeypatch):
+    agent.stream.acking = False
+    agent.current["cpu"] = 95.0
+    agent.tick()  # sent but never acknowledged
+    assert patches(agent) == []
+    monkeypatch.setattr(vm_agent, "STREAM_ACK_TIMEOUT", -1)  # any unacked sample is overdue
+    agent.tick()
+    assert not agent.stream.connected()
+    # The unacknowledged sample isn't taken as delivered, so the CPU goes by HTTP.
+    assert patches(agent)[-1]["cpu"] == 95.0
+
+
+def test_server_close_falls_back_to_http(agent):
+    agent.stream.closed_by_server = "closed by server (4404 VM not registered)"
+    agent.current["memory"] = 90.0
+    agent.tick()
+    assert not agent.stream.connected()
+    assert patches(agent)[-1]["memory"] == 90.0
+
+
+class SimClock:
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def wait(self, event, timeout):
+        self.now += timeout
+        return event.is_set()
+
+
+class SlowTransport(FakeTransport):
+    # Every request takes latency seconds of simulated time.
+    def __init__(self, clock, latency):
+        super().__init__()
+        self.clock = clock
+        self.latency = latency
+        self.arrivals = []
+
+    def request(self, method, url, headers=None, data=None, **kwargs):
+        self.clock.now += self.latency
+        self.arrivals.append(self.clock.now)
+        return super().request(method, url, headers=headers, data=data, **kwargs)
+
+
+@pytest.mark.parametrize("phase", [0.5, 2.0, 4.5])
+def test_idle_heartbeat_stays_inside_offline_threshold(tmp_path, phase):
+    clock = SimClock()
+    transport = SlowTransport(clock, latency=0.3)
+    current = base_sample()
+    agent = vm_agent.Agent("user@example.com", "token", agent_id="vm-1",
+                           collectors=[lambda: copy.deepcopy(current)], transport=transport,
+                           clock=clock, spool_dir=str(tmp_path), stream=FakeStream())
+    agent.stream = None
+    agent.encoder = vm_agent.PayloadEncoder(algorithm=None)
+    for tick in range(40):
+        # Sampling on the boundary, the real-time upload at the phase offset.
+        clock.now = 1700000000.0 + tick * vm_agent.SAMPLE_INTERVAL
+        agent.sample_metrics(0.0)
+        clock.now += phase
+        agent.update_realtime(0.0)
+    sent = [vm_agent.parse_timestamp(body["last_updated"]) for _, body in transport.calls]
+    assert len(sent) > 10
+    assert max(b - a for a, b in zip(sent, sent[1:])) <= vm_agent.REALTIME_HEARTBEAT_INTERVAL
+    # How old the dashboard's last_updated is when the next one lands.
+    assert max(arrival - previous for previous, arrival in zip(sent, transport.arrivals[1:])) < 15
@@ -0,0 +1,109 @@
+import collections
+
+import vm_agent
+
+
+class SimClock:
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def wait(self, event, timeout):
+        self.now += timeout
+        return event.is_set()
+
+
+# --- Disk I/O ---
+DiskIo = collections.namedtuple(
+    "DiskIo", "read_count write_count read_bytes write_bytes read_time write_time")
+
+
+def disk_io(writes, written):
+    return DiskIo(0, writes, 0, written, 0, writes)  # 1ms per write
+
+
+def test_stacked_devices_are_reported_but_not_totalled(monkeypatch):
+    # LVM on sda and md0 mirrored over sdb and sdc.
+    monkeypatch.setattr(vm_agent, "_block_devices", lambda: {"sda", "sdb", "sdc", "dm-0", "md0"})
+    monkeypatch.setattr(vm_agent, "_stacked_block_devices", lambda devices: {"dm-0", "md0"})
+    counters = {name: disk_io(0, 0) for name in ("sda", "sdb", "sdc", "dm-0", "md0")}
+    monkeypatch.setattr(vm_agent.psutil, "disk_io_counters", lambda perdisk: counters)
+    clock = SimClock()
+    sampler = vm_agent.DiskIoSampler(clock)
+    counters.update({"sda": disk_io(100, 1000), "dm-0": disk_io(100, 1000),
+                     "sdb": disk_io(50, 500), "sdc": disk_io(50, 500), "md0": disk_io(50, 500)})
+    clock.now += 10
+    disk = sampler.collect()["disk_io"]
+    assert sorted(d["device"] for d in disk["devices"]) == ["dm-0", "md0", "sda", "sdb", "sdc"]
+    assert disk["write_bytes_per_sec"] == 200.0
+    assert disk["iops"] == 20.0
+    assert disk["await_ms"] == 1.0
+
+
+# --- Network Throughput ---
+WRAP = vm_agent.COUNTER_WRAP_32
+GIGABIT_TICK = 10 ** 9 / 8 * 5  # bytes a 1 Gbit/s link can move in 5s
+
+
+def test_counter_delta_counts_forward_steps():
+    assert vm_agent.counter_delta(100, 250, 0) == 150
+
+
+def test_counter_delta_accepts_a_wrap_the_link_could_carry():
+    assert vm_agent.counter_delta(WRAP - 1000, 500, GIGABIT_TICK) == 1500
+
+
+def test_counter_delta_treats_an_impossible_wrap_as_a_reset():
+    # As a wrap this would be 1.29 GB in one tick.
+    assert vm_agent.counter_delta(3000000000, 100, GIGABIT_TICK) == 100
+    # A 64-bit counter going backwards never wrapped.
+    assert vm_agent.counter_delta(WRAP + 5, 100, GIGABIT_TICK) == 100
+
+
+NicIo = collections.namedtuple("NicIo", vm_agent.NETWORK_COUNTERS)
+NicStats = collections.namedtuple("NicStats", "speed")
+
+
+def nic_io(sent, packets):
+    return NicIo(sent, 0, packets, 0, 0, 0, 0, 0)
+
+
+def network_sampler(monkeypatch, speeds, counters):
+    monkeypatch.setattr(vm_agent.psutil, "net_io_counters", lambda pernic, nowrap: dict(counters))
+    monkeypatch.setattr(vm_agent.psutil, "net_if_stats",
+                        lambda: {name: NicStats(speed) for name, speed in speeds.items()})
+    clock = SimClock()
+    return clock, vm_agent.NetworkSampler(clock)
+
+
+def test_wraps_are_judged_against_each_links_speed(monkeypatch):
+    # The same 1.5 GB backwards step: a wrap on 10 Gbit/s, a reset on 100 Mbit/s.
+    start = nic_io(WRAP - 10 ** 9, WRAP - 1000)
+    counters = {"fast": start, "slow": start}
+    clock, sampler = network_sampler(monkeypatch, {"fast": 10000, "slow": 100}, counters)
+    counters.update(fast=nic_io(5 * 10 ** 8, 1000), slow=nic_io(5 * 10 ** 8, 1000))
+    clock.now += 5
+    interfaces = {nic["name"]: nic for nic in sampler.collect()["network"]["interfaces"]}
+    assert interfaces["fast"]["bytes_sent_per_sec"] == 3 * 10 ** 8
+    assert interfaces["slow"]["bytes_sent_per_sec"] == 10 ** 8
+    assert interfaces["fast"]["packets_sent_per_sec"] == 400.0
+    assert interfaces["slow"]["packets_sent_per_sec"] == 400.0
+
+
+def test_unknown_link_speed_falls_back_to_a_cap(monkeypatch):
+    counters = {"eth0": nic_io(3000000000, 0)}
+    clock, sampler = network_sampler(monkeypatch, {"eth0": 0}, counters)
+    counters["eth0"] = nic_io(100, 0)  # a restart, not 1.29 GB in 5s
+    clock.now += 5
+    assert sampler.collect()["network"]["bytes_sent_per_sec"] == 20.0
+    counters["eth0"] = nic_io(WRAP - 1000, 0)
+    clock.now += 5
+    sampler.collect()
+    counters["eth0"] = nic_io(9000, 0)  # a genuine wrap
+    clock.now += 5
+    assert sampler.collect()["network"]["bytes_sent_per_sec"] == 2000.0
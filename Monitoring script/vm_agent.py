@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import uuid
 import socket
@@ -7,8 +8,33 @@ import time
 import datetime
 import psutil
 import requests
+from requests.adapters import HTTPAdapter
 import getpass
 import threading
+import collections
+import struct
+import zlib
+import math
+import base64
+import random
+import hashlib
+import bisect
+import array
+import gzip
+import select
+from email.utils import parsedate_to_datetime
+
+# Optional: zstd request compression (pip install zstandard)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Optional: streaming real-time channel (pip install websocket-client)
+try:
+    import websocket
+except ImportError:
+    websocket = None
 
 # --- Utility: Get or Create a Local Agent ID ---
 def get_agent_id():
@@ -22,14 +48,118 @@ def get_agent_id():
             f.write(agent_id)
     return agent_id
 
-# --- Login Function ---
-def login_and_get_token():
+# --- API Endpoints ---
+API_ROOT = "https://test.sanambir.com/api"
+LOGIN_URL = f"{API_ROOT}/auth/login"
+REFRESH_URL = f"{API_ROOT}/auth/refresh"
+USERS_URL = f"{API_ROOT}/users"
+# Real-time update endpoint (PUT/PATCH /vms/<agent id>) and VM creation endpoint (POST)
+API_BASE_URL = f"{API_ROOT}/vms"
+# Aggregated performance endpoint (POST) and its batch variant
+PERFORMANCE_URL = f"{API_ROOT}/performance"
+PERFORMANCE_BULK_URL = f"{PERFORMANCE_URL}/bulk"
+
+# --- HTTP Transport ---
+# Every API call goes through one pooled session so connections to the
+# backend stay alive and the TCP/TLS handshake is paid once, not on every
+# request. All calls get connect/read deadlines so a stalled server can never
+# hang a loop forever. Anything with the same request()/close() methods can
+# stand in for it, e.g. a recording transport under a benchmark harness.
+CONNECT_TIMEOUT = 5   # seconds
+READ_TIMEOUT = 15     # seconds
+HTTP_POOL_SIZE = 4    # one connection per agent thread plus headroom
+
+class HttpTransport:
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+# --- Credentials and Token Cache ---
+# The agent can start without a prompt: credentials come from the environment
+# (VM_AGENT_EMAIL / VM_AGENT_PASSWORD) or a JSON config file
+# ({"email": ..., "password": ...}), and the last token is cached on disk so
+# a restart within its lifetime skips the login round trips entirely.
+CONFIG_FILE = os.environ.get("VM_AGENT_CONFIG", "agent_config.json")
+TOKEN_CACHE_FILE = "agent_token.json"
+TOKEN_REFRESH_MARGIN = 600  # seconds of validity left when a token is renewed
+TOKEN_CHECK_INTERVAL = 60   # seconds between expiry checks
+
+def load_config():
+    config = {}
+    if os.path.exists(CONFIG_FILE):
+        try:
+            with open(CONFIG_FILE, "r") as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable config file {CONFIG_FILE}:", e)
+        if not isinstance(config, dict):
+            print(f"Ignoring config file {CONFIG_FILE}: expected a JSON object.")
+            config = {}
+    for key in ("email", "password"):
+        value = os.environ.get("VM_AGENT_" + key.upper())
+        if value:
+            config[key] = value
+    return config
+
+def prompt_credentials():
     email = input("Enter your email address: ").strip()
     password = getpass.getpass("Enter your password: ")
-    login_url = "https://test.sanambir.com/api/auth/login"
+    return email, password
+
+def token_expiry(token):
+    # Read the exp claim without verifying the signature; the server does that.
     try:
-        response = requests.post(
-            login_url,
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+    except Exception:
+        return None
+
+def token_is_fresh(token, clock=None):
+    expiry = token_expiry(token)
+    now = clock.time() if clock is not None else time.time()
+    return expiry is not None and expiry - now > TOKEN_REFRESH_MARGIN
+
+def load_cached_token(email=None):
+    if not os.path.exists(TOKEN_CACHE_FILE):
+        return None, None
+    try:
+        with open(TOKEN_CACHE_FILE, "r") as f:
+            cached = json.load(f)
+    except Exception as e:
+        print("Ignoring unreadable token cache:", e)
+        return None, None
+    if email and cached.get("email") != email:
+        return None, None
+    if not token_is_fresh(cached.get("token", "")):
+        return None, None
+    return cached["email"], cached["token"]
+
+def save_cached_token(email, token):
+    # Write to a private temporary file and rename it into place, so a crash
+    # never leaves a half-written cache behind.
+    temp_file = TOKEN_CACHE_FILE + ".tmp"
+    fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"email": email, "token": token}, f)
+    os.replace(temp_file, TOKEN_CACHE_FILE)
+
+# --- Login Function ---
+def login_and_get_token(transport, email, password):
+    try:
+        response = transport.request(
+            "POST",
+            LOGIN_URL,
             json={"email": email, "password": password},
             headers={"Content-Type": "application/json"}
         )
@@ -38,26 +168,37 @@ def login_and_get_token():
             token = data.get("token")
             if token:
                 print("Login successful.")
-                return email, token
+                return token
             else:
                 print("Login failed: Token not received.")
-                exit(1)
+                return None
         else:
             print("Login failed:", response.text)
-            exit(1)
+            return None
     except Exception as e:
         print("Error during login:", e)
-        exit(1)
+        return None
+
+def refresh_token(transport, token):
+    try:
+        response = transport.request("POST", REFRESH_URL, headers={"Authorization": "Bearer " + token})
+        if response.status_code in (200, 201):
+            return response.json().get("token")
+        print("Token refresh failed:", response.status_code, response.text)
+        return None
+    except Exception as e:
+        print("Error refreshing token:", e)
+        return None
 
 # --- Function to Check if User is Registered ---
-def check_user_exists(email, token):
-    url = "https://test.sanambir.com/api/users?email=" + email
+def check_user_exists(transport, email, token):
+    url = USERS_URL + "?email=" + email
     headers = {
         "Content-Type": "application/json",
         "Authorization": "Bearer " + token
     }
     try:
-        response = requests.get(url, headers=headers)
+        response = transport.request("GET", url, headers=headers)
         print("User check response status:", response.status_code)
         if response.status_code == 200:
             if response.text.strip() == "":
@@ -77,154 +218,2336 @@ def check_user_exists(email, token):
         return False
 
 # --- Timestamp Helper ---
-def get_current_timestamp():
-    return datetime.datetime.now(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+def format_timestamp(epoch):
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).isoformat().replace("+00:00", "Z")
 
-# --- Main Initialization ---
-agent_id = get_agent_id()
-host_name = socket.gethostname()
-os_type = platform.system()
+def parse_timestamp(timestamp):
+    # Inverse of format_timestamp (fromisoformat needs Python 3.7+ and no "Z").
+    fmt = "%Y-%m-%dT%H:%M:%S.%fZ" if "." in timestamp else "%Y-%m-%dT%H:%M:%SZ"
+    moment = datetime.datetime.strptime(timestamp, fmt).replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
 
-USER_EMAIL, USER_TOKEN = login_and_get_token()
+# --- Clock ---
+# The agent reads time and waits only through a clock object: the scheduler,
+# the samplers' rate calculations, the spool and the background loops. A
+# harness can drive all of it with a simulated clock whose wait() advances
+# simulated time instead of sleeping.
+class SystemClock:
+    def monotonic(self):
+        return time.monotonic()
 
-if not check_user_exists(USER_EMAIL, USER_TOKEN):
-    print("This email is not registered on the dashboard. Please register there first.")
-    exit(1)
-else:
-    print("User found. Proceeding with monitoring...")
+    def time(self):
+        return time.time()
 
-# --- API Endpoints ---
-# Real-time update endpoint (PUT) and VM creation endpoint (POST)
-API_BASE_URL = "https://test.sanambir.com/api/vms"
-API_URL = f"{API_BASE_URL}/{agent_id}"
-# Aggregated performance endpoint (POST)
-PERFORMANCE_URL = "https://test.sanambir.com/api/performance"
+    def wait(self, event, timeout):
+        # Blocks until event is set or timeout passes; returns whether it was set.
+        return event.wait(timeout)
+
+# --- Drift-Free Scheduler ---
+# Jobs fire on absolute deadlines from the monotonic clock, so the period
+# does not stretch by however long the job itself takes. With align=True the
+# first deadline lands on a wall-clock multiple of the interval (e.g. :00,
+# :05, :10). If a job overruns, the missed deadlines are skipped rather than
+# fired back to back. With an offset, aligned deadlines land that many
+# seconds after each boundary, and an unaligned job first fires that many
+# seconds from now. The loop returns as soon as stop_event is set.
+def run_every(name, interval, job, stop_event, align=False, clock=None, stats=None, offset=0.0):
+    clock = clock or SystemClock()
+    stats = (stats if stats is not None else {}).setdefault(
+        name, {"ticks": 0, "skipped": 0, "last_lateness": 0.0, "max_lateness": 0.0}
+    )
+    next_deadline = clock.monotonic()
+    if align:
+        next_deadline += (interval + offset - clock.time() % interval) % interval
+    else:
+        next_deadline += offset
+    while not stop_event.is_set():
+        delay = next_deadline - clock.monotonic()
+        if delay > 0 and clock.wait(stop_event, delay):
+            break
+        lateness = clock.monotonic() - next_deadline
+        missed = int(lateness // interval)
+        if missed:
+            print(f"{name}: running {lateness:.2f}s late, skipping {missed} missed tick(s).")
+            lateness -= missed * interval
+        next_deadline += (missed + 1) * interval
+        stats["ticks"] += 1
+        stats["skipped"] += missed
+        stats["last_lateness"] = lateness
+        stats["max_lateness"] = max(stats["max_lateness"], lateness)
+        try:
+            job(lateness)
+        except Exception as e:
+            print(f"Error in {name} job:", e)
+
+# --- Fleet Phase Spreading ---
+# Agents deployed together would otherwise all upload at the same instant.
+# Each agent derives a stable offset from its ID and uploads at that point
+# within every interval, so a fleet's requests are spread evenly across it.
+# Sampling itself stays on the shared boundaries, so timestamps from
+# different VMs still line up.
+PHASE_SPREAD = (0.1, 0.9)  # part of each interval uploads are spread over
+
+def phase_offset(agent_id, interval):
+    digest = hashlib.sha256(f"{agent_id}:{interval}".encode("utf-8")).digest()
+    fraction = int.from_bytes(digest[:8], "big") / 2 ** 64
+    low, high = PHASE_SPREAD
+    return (low + (high - low) * fraction) * interval
+
+# --- CPU Measurement Engine ---
+# Utilisation is computed from the difference between successive cumulative
+# cpu_times() snapshots, so a reading returns immediately and covers exactly
+# the time since the previous tick, whatever its length. One per-core snapshot
+# per tick yields the per-core figures, the overall time-share breakdown
+# (steal and irq included, which a single cpu percentage hides) and, with one
+# cpu_stats() call, context switch and interrupt rates. Counters live in
+# arrays allocated once, so a tick allocates little beyond its result.
+CPU_BREAKDOWN_FIELDS = ("user", "system", "iowait", "irq", "softirq", "steal")
+# Windows reports hardware and deferred interrupt time under other names.
+CPU_FIELD_ALIASES = {"interrupt": "irq", "dpc": "softirq"}
+CPU_IDLE_FIELDS = ("idle", "iowait")
+# On Linux guest time is already counted in user/nice.
+CPU_GUEST_FIELDS = ("guest", "guest_nice")
+CPU_ACTIVITY_FIELDS = ("ctx_switches", "interrupts", "soft_interrupts")
+
+def _busy_percent(busy, total):
+    return round(min(max(busy / total * 100, 0.0), 100.0), 1) if total > 0 else 0.0
+
+class CpuSampler:
+    def __init__(self, clock=None):
+        self.clock = clock or SystemClock()
+        self._allocate(psutil.cpu_times(percpu=True))
+        self._activity = array.array("d", [0.0] * len(CPU_ACTIVITY_FIELDS))
+        self._activity_time = None
+        self._read_activity()
+
+    def _allocate(self, snapshot):
+        # Sized for the current core count; rebuilt if CPUs are hot-plugged.
+        fields = snapshot[0]._fields
+        self._width = len(fields)
+        self._idle = [i for i, field in enumerate(fields) if field in CPU_IDLE_FIELDS]
+        self._guest = [i for i, field in enumerate(fields) if field in CPU_GUEST_FIELDS]
+        self._shares = [
+            (CPU_FIELD_ALIASES.get(field, field), i) for i, field in enumerate(fields)
+            if CPU_FIELD_ALIASES.get(field, field) in CPU_BREAKDOWN_FIELDS
+        ]
+        self._last = array.array("d", [value for times in snapshot for value in times])
+        self._totals = array.array("d", [0.0] * self._width)
+        self._deltas = array.array("d", [0.0] * self._width)
+        self._core_busy = array.array("d", [0.0] * len(snapshot))
+
+    def _read_activity(self):
+        # Rates per second of the cumulative cpu_stats() counters since the
+        # last call; a counter that went backwards (wrap or reset) reads 0.
+        stats = psutil.cpu_stats()
+        now = self.clock.monotonic()
+        elapsed = now - self._activity_time if self._activity_time is not None else 0.0
+        self._activity_time = now
+        rates = {}
+        for i, field in enumerate(CPU_ACTIVITY_FIELDS):
+            value = getattr(stats, field)
+            delta = value - self._activity[i]
+            self._activity[i] = value
+            rates[field] = round(delta / elapsed, 1) if elapsed > 0 and delta >= 0 else 0.0
+        return rates
+
+    def sample(self):
+        snapshot = psutil.cpu_times(percpu=True)
+        if len(snapshot) * self._width != len(self._last):
+            self._allocate(snapshot)
+        width, last, totals, deltas = self._width, self._last, self._totals, self._deltas
+        for i in range(width):
+            totals[i] = 0.0
+        for core, times in enumerate(snapshot):
+            base = core * width
+            for i, value in enumerate(times):
+                # Counters can step backwards slightly on some kernels; clamp at zero.
+                delta = value - last[base + i]
+                deltas[i] = delta if delta > 0 else 0.0
+                last[base + i] = value
+                totals[i] += deltas[i]
+            core_total = sum(deltas) - sum(deltas[i] for i in self._guest)
+            core_idle = sum(deltas[i] for i in self._idle)
+            self._core_busy[core] = _busy_percent(core_total - core_idle, core_total)
+        total = sum(totals) - sum(totals[i] for i in self._guest)
+        idle = sum(totals[i] for i in self._idle)
+        shares = dict.fromkeys(CPU_BREAKDOWN_FIELDS, 0.0)
+        if total > 0:
+            for name, i in self._shares:
+                shares[name] = round(totals[i] / total * 100, 1)
+        shares["per_core"] = self._core_busy.tolist()
+        shares["max_core"] = max(shares["per_core"])  # one saturated core hides in the average
+        return _busy_percent(total - idle, total), shares
+
+    def collect(self):
+        percent, shares = self.sample()
+        sample = {"cpu": percent, "cpu_breakdown": shares, "cpu_activity": self._read_activity()}
+        if hasattr(psutil, "getloadavg"):
+            sample["load_avg"] = [round(load, 2) for load in psutil.getloadavg()]
+        return sample
 
 # --- Real-Time Metrics Collection ---
-def collect_metrics():
-    return {
-        "cpu": psutil.cpu_percent(interval=1),
-        "memory": psutil.virtual_memory().percent,
-        "disk": psutil.disk_usage('/').percent,
-    }
+# A collector is any callable returning a dict of sample fields. The agent
+# calls each one once per tick and merges the results into a single sample.
+def collect_memory():
+    return {"memory": psutil.virtual_memory().percent}
 
-# --- Helper: Create VM Record if Not Found ---
-def create_vm():
-    vm_data = {
-        "_id": agent_id,
-        "name": host_name,
-        "os": os_type,
-        "cpu": 0,
-        "memory": 0,
-        "disk": 0,
-        "network": {
-            "bytes_sent": 0,
-            "bytes_recv": 0,
-            "packets_sent": 0,
-            "packets_recv": 0,
-        },
-        "status": "Running",
-        "last_updated": get_current_timestamp(),
-        "user": USER_EMAIL
-    }
-    headers = {"Authorization": "Bearer " + USER_TOKEN}
+def collect_disk_usage():
+    return {"disk": psutil.disk_usage('/').percent}
+
+
+# --- Filesystem Capacity ---
+# Bytes and inodes for every mounted filesystem of a real type (local disks
+# and network shares, not proc, tmpfs, cgroup and the like). A statvfs() on a
+# dead NFS server blocks forever, so each mount is checked on its own daemon
+# thread and the sampler never waits: a tick reports the most recent finished
+# result per mount, and a check still running after FILESYSTEM_CHECK_TIMEOUT
+# flags the mount as hung. No new check is started on a mount until its stuck
+# one returns, so a wedged share costs one parked thread, not one per tick.
+FILESYSTEM_TYPES = {
+    "ext2", "ext3", "ext4", "xfs", "btrfs", "zfs", "f2fs", "jfs", "reiserfs",
+    "vfat", "exfat", "ntfs", "fuseblk", "refs", "fat32", "apfs", "hfs", "ufs",
+    "nfs", "nfs4", "cifs", "smb3", "smbfs", "ceph", "fuse.glusterfs",
+}
+FILESYSTEM_CHECK_TIMEOUT = 2      # seconds before a check in flight counts as hung
+FILESYSTEM_REFRESH_INTERVAL = 30  # seconds; capacity moves slowly
+
+def _filesystem_usage(partition):
+    usage = {"mount": partition.mountpoint, "device": partition.device,
+             "fstype": partition.fstype, "hung": False}
+    if hasattr(os, "statvfs"):
+        st = os.statvfs(partition.mountpoint)
+        used = (st.f_blocks - st.f_bfree) * st.f_frsize
+        available = st.f_bavail * st.f_frsize
+        usage.update(total=st.f_blocks * st.f_frsize, used=used, free=available,
+                     # Same formula as df: reserved blocks are neither used nor available.
+                     percent=round(used / (used + available) * 100, 1) if used + available else 0.0)
+        if st.f_files:
+            inodes_used = st.f_files - st.f_ffree
+            usage.update(inodes_total=st.f_files, inodes_used=inodes_used,
+                         inodes_percent=round(inodes_used / st.f_files * 100, 1))
+    else:
+        disk = psutil.disk_usage(partition.mountpoint)
+        usage.update(total=disk.total, used=disk.used, free=disk.free, percent=disk.percent)
+    return usage
+
+class FilesystemSampler:
+    def __init__(self, timeout=FILESYSTEM_CHECK_TIMEOUT, refresh=FILESYSTEM_REFRESH_INTERVAL, clock=None):
+        self.clock = clock or SystemClock()
+        self.timeout = timeout
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._results = {}    # mount -> latest finished usage
+        self._checked = {}    # mount -> monotonic time of that result
+        self._in_flight = {}  # mount -> monotonic start of the running check
+
+    def _mounts(self):
+        mounts, devices = [], set()
+        for partition in psutil.disk_partitions(all=True):
+            if partition.fstype.lower() not in FILESYSTEM_TYPES:
+                continue
+            # Bind mounts and re-mounts of one device would repeat the same numbers.
+            if partition.device in devices:
+                continue
+            devices.add(partition.device)
+            mounts.append(partition)
+        return mounts
+
+    def _check(self, partition):
+        try:
+            usage = _filesystem_usage(partition)
+        except Exception as e:
+            usage = {"mount": partition.mountpoint, "device": partition.device,
+                     "fstype": partition.fstype, "hung": False, "error": str(e)}
+        with self._lock:
+            self._results[partition.mountpoint] = usage
+            self._checked[partition.mountpoint] = self.clock.monotonic()
+            self._in_flight.pop(partition.mountpoint, None)
+
+    def collect(self):
+        now = self.clock.monotonic()
+        filesystems = []
+        for partition in self._mounts():
+            mount = partition.mountpoint
+            with self._lock:
+                started = self._in_flight.get(mount)
+                due = started is None and now - self._checked.get(mount, -math.inf) >= self.refresh
+                if due:
+                    self._in_flight[mount] = now
+                usage = self._results.get(mount)
+            if due:
+                threading.Thread(target=self._check, args=(partition,), name=f"fs-check {mount}",
+                                 daemon=True).start()
+            if started is not None and now - started >= self.timeout:
+                filesystems.append({"mount": mount, "device": partition.device,
+                                    "fstype": partition.fstype, "hung": True})
+            elif usage is not None:
+                filesystems.append(usage)
+        return {"filesystems": filesystems}
+
+# --- Disk I/O ---
+# Per-device throughput, IOPS, average service time and queue depth from
+# successive disk_io_counters(perdisk=True) snapshots. A device that appears
+# reports from its second tick on, one that vanishes is dropped, and one
+# whose counters went backwards (re-attached or reset) starts over. Queue
+# depth is the average number of requests in flight: the time requests spent
+# in the device divided by the elapsed time. Utilisation needs busy_time,
+# which only Linux and FreeBSD report.
+# Stacked devices (device-mapper, md RAID: anything with entries under
+# /sys/block/<dev>/slaves) are still reported per device but left out of the
+# totals, which count each request once, on the physical disks it reached.
+DISK_IO_SKIP_PREFIXES = ("loop", "ram", "zram")  # virtual devices that aren't real disks
+
+def _block_devices():
+    # Whole disks on Linux; partitions would count the same I/O twice.
     try:
-        response = requests.post(API_BASE_URL, json=vm_data, headers=headers)
-        if response.status_code in (200, 201):
-            print("VM created successfully in database.")
+        return set(os.listdir("/sys/block"))
+    except OSError:
+        return None
+
+def _stacked_block_devices(devices):
+    # Devices built on top of others, whose I/O the disks below count again.
+    stacked = set()
+    for name in devices or ():
+        try:
+            if os.listdir(f"/sys/block/{name}/slaves"):
+                stacked.add(name)
+        except OSError:
+            pass
+    return stacked
+
+class DiskIoSampler:
+    def __init__(self, clock=None):
+        self.clock = clock or SystemClock()
+        self._last = {}
+        self._last_time = None
+        self._whole_disks = _block_devices()
+        self._stacked = _stacked_block_devices(self._whole_disks)
+        self.collect()
+
+    def collect(self):
+        try:
+            counters = psutil.disk_io_counters(perdisk=True) or {}
+        except Exception:
+            counters = {}
+        now = self.clock.monotonic()
+        elapsed = now - self._last_time if self._last_time is not None else 0.0
+        self._last_time = now
+        previous, self._last = self._last, {}
+        devices = []
+        for name, current in counters.items():
+            if name.startswith(DISK_IO_SKIP_PREFIXES):
+                continue
+            if self._whole_disks is not None and name not in self._whole_disks:
+                continue
+            self._last[name] = current
+            last = previous.get(name)
+            if last is None or elapsed <= 0 or any(c < l for c, l in zip(current, last)):
+                continue
+            reads = current.read_count - last.read_count
+            writes = current.write_count - last.write_count
+            io_time = (current.read_time - last.read_time) + (current.write_time - last.write_time)  # ms
+            device = {
+                "device": name,
+                "read_bytes_per_sec": round((current.read_bytes - last.read_bytes) / elapsed, 1),
+                "write_bytes_per_sec": round((current.write_bytes - last.write_bytes) / elapsed, 1),
+                "read_iops": round(reads / elapsed, 1),
+                "write_iops": round(writes / elapsed, 1),
+                "await_ms": round(io_time / (reads + writes), 2) if reads + writes else 0.0,
+                "queue_depth": round(io_time / (elapsed * 1000), 2),
+            }
+            if hasattr(current, "busy_time"):
+                busy = (current.busy_time - last.busy_time) / (elapsed * 1000) * 100
+                device["util"] = round(min(busy, 100.0), 1)
+            devices.append(device)
+        if not devices:
+            return {}
+        disks = [d for d in devices if d["device"] not in self._stacked]
+        ops = sum(d["read_iops"] + d["write_iops"] for d in disks)
+        return {"disk_io": {
+            "read_bytes_per_sec": round(sum(d["read_bytes_per_sec"] for d in disks), 1),
+            "write_bytes_per_sec": round(sum(d["write_bytes_per_sec"] for d in disks), 1),
+            "iops": round(ops, 1),
+            # Mean service time over all requests, not over devices.
+            "await_ms": round(sum(d["await_ms"] * (d["read_iops"] + d["write_iops"]) for d in disks) / ops, 2) if ops else 0.0,
+            "queue_depth": round(sum(d["queue_depth"] for d in disks), 2),
+            "devices": devices,
+        }}
+
+# --- Network Throughput ---
+# One per-NIC net_io_counters() snapshot per tick gives cumulative totals and,
+# against the previous snapshot, per-interface and overall rates per second.
+# A counter that goes backwards has either wrapped (32-bit counters on some
+# platforms and drivers) or been reset by an interface restart or a reboot
+# under a restored VM. A wrap is only believed if the step it implies fits
+# the link: no more bytes than its speed (net_if_stats) allows over the
+# elapsed time, and no more packets than that many minimum-size frames.
+# Where the speed is unknown (psutil reports 0, as many virtual NICs do)
+# NETWORK_FALLBACK_MAX_RATE stands in. Anything else counts from zero.
+# Loopback traffic is left out.
+NETWORK_COUNTERS = ("bytes_sent", "bytes_recv", "packets_sent", "packets_recv",
+                    "errin", "errout", "dropin", "dropout")
+COUNTER_WRAP_32 = 2 ** 32
+NETWORK_FALLBACK_MAX_RATE = 10 ** 9 / 8  # bytes per second (1 Gbit/s)
+NETWORK_MIN_FRAME_BYTES = 64
+
+def counter_delta(previous, current, limit):
+    # limit: the largest step a wrap may imply.
+    if current >= previous:
+        return current - previous
+    if previous < COUNTER_WRAP_32:
+        wrapped = COUNTER_WRAP_32 - previous + current
+        if wrapped <= limit:
+            return wrapped
+    return current
+
+def _link_speeds():
+    # Mbit/s per NIC; 0 where the driver doesn't report one.
+    try:
+        return {name: stats.speed for name, stats in psutil.net_if_stats().items()}
+    except Exception:
+        return {}
+
+def _is_loopback(name):
+    return name in ("lo", "lo0") or name.startswith("Loopback")
+
+class NetworkSampler:
+    def __init__(self, clock=None):
+        self.clock = clock or SystemClock()
+        self._last = {}
+        self._last_time = None
+        self.collect()
+
+    def collect(self):
+        # nowrap=False: wraps and resets are handled here, per counter.
+        counters = psutil.net_io_counters(pernic=True, nowrap=False)
+        now = self.clock.monotonic()
+        elapsed = now - self._last_time if self._last_time is not None else 0.0
+        self._last_time = now
+        previous, self._last = self._last, {}
+        network = dict.fromkeys(NETWORK_COUNTERS, 0)
+        rates = dict.fromkeys(NETWORK_COUNTERS, 0.0)
+        interfaces = []
+        speeds = _link_speeds() if previous else {}
+        for name, current in counters.items():
+            if _is_loopback(name):
+                continue
+            self._last[name] = current
+            for field in NETWORK_COUNTERS:
+                network[field] += getattr(current, field)
+            last = previous.get(name)
+            if last is None or elapsed <= 0:
+                continue  # a new interface reports rates from its second tick
+            interface = {"name": name}
+            speed = speeds.get(name) or 0
+            max_bytes = (speed * 10 ** 6 / 8 if speed > 0 else NETWORK_FALLBACK_MAX_RATE) * elapsed
+            for field in NETWORK_COUNTERS:
+                limit = max_bytes if field.startswith("bytes") else max_bytes / NETWORK_MIN_FRAME_BYTES
+                rate = counter_delta(getattr(last, field), getattr(current, field), limit) / elapsed
+                interface[field + "_per_sec"] = round(rate, 1)
+                rates[field] += rate
+            interfaces.append(interface)
+        if elapsed > 0:
+            for field in NETWORK_COUNTERS:
+                network[field + "_per_sec"] = round(rates[field], 1)
+        network["interfaces"] = interfaces
+        return {"network": network}
+
+# --- TCP Connections ---
+# Per-state connection counts for Linux hosts, read straight from the kernel's
+# socket tables. psutil.net_connections() builds a tuple per socket and maps
+# every inode back to a process, which takes seconds with 100k sockets; here a
+# line costs one find(), one slice and a dict increment. The state column sits
+# at a fixed distance from the "sl:" prefix (addresses are fixed-width hex), so
+# lines are never split. /proc/net/sockstat{,6} supplies totals and
+# /proc/net/netstat the listen-queue overflow counters; both are a few lines.
+# To keep the cost bounded, a table scan never reads more than
+# TCP_SCAN_MAX_SOCKETS lines, and after a scan that took d seconds the next
+# waits TCP_SCAN_DUTY_CYCLE * d; in between, ticks reuse the last counts.
+TCP_TABLES = (("/proc/net/tcp", 30), ("/proc/net/tcp6", 78))  # path, state offset after "sl:"
+TCP_STATES = {
+    b"01": "ESTABLISHED", b"02": "SYN_SENT", b"03": "SYN_RECV", b"04": "FIN_WAIT1",
+    b"05": "FIN_WAIT2", b"06": "TIME_WAIT", b"07": "CLOSE", b"08": "CLOSE_WAIT",
+    b"09": "LAST_ACK", b"0A": "LISTEN", b"0B": "CLOSING", b"0C": "NEW_SYN_RECV",
+}
+TCP_LISTEN = b"0A"
+TCP_SCAN_MAX_SOCKETS = 250000
+TCP_SCAN_DUTY_CYCLE = 20  # a scan may use at most 1/20 of the time between scans
+TCP_READ_BUFFER = 1024 * 1024
+TCP_LISTEN_COUNTERS = (("ListenOverflows", "listen_overflows"), ("ListenDrops", "listen_drops"))
+
+def _scan_tcp_table(path, state_offset, counts, limit):
+    # Adds each socket's state to counts and returns (lines read, connections
+    # waiting in LISTEN sockets' accept queues). The rx_queue column of a
+    # listening socket is its accept backlog.
+    scanned = queued = 0
+    with open(path, "rb", buffering=TCP_READ_BUFFER) as table:
+        table.readline()  # header
+        for line in table:
+            if scanned >= limit:
+                break
+            scanned += 1
+            start = line.find(b":") + state_offset
+            state = line[start:start + 2]
+            counts[state] = counts.get(state, 0) + 1
+            if state == TCP_LISTEN:
+                queued += int(line[start + 12:start + 20], 16)
+    return scanned, queued
+
+def _read_sockstat():
+    totals = {}
+    for path in ("/proc/net/sockstat", "/proc/net/sockstat6"):
+        try:
+            with open(path) as f:
+                for line in f:
+                    protocol, _, values = line.partition(":")
+                    if protocol not in ("TCP", "TCP6"):
+                        continue
+                    fields = values.split()
+                    for key, value in zip(fields[::2], fields[1::2]):
+                        totals[key] = totals.get(key, 0) + int(value)
+        except (OSError, ValueError):
+            continue
+    return totals
+
+def _read_listen_counters():
+    # /proc/net/netstat holds header/value line pairs per protocol extension.
+    try:
+        with open("/proc/net/netstat") as f:
+            lines = f.readlines()
+    except OSError:
+        return {}
+    for names, values in zip(lines[::2], lines[1::2]):
+        if names.startswith("TcpExt:"):
+            row = dict(zip(names.split()[1:], values.split()[1:]))
+            return {key: int(row[name]) for name, key in TCP_LISTEN_COUNTERS if name in row}
+    return {}
+
+class TcpSampler:
+    def __init__(self, max_sockets=TCP_SCAN_MAX_SOCKETS, duty_cycle=TCP_SCAN_DUTY_CYCLE, clock=None):
+        self.clock = clock or SystemClock()
+        self.max_sockets = max_sockets
+        self.duty_cycle = duty_cycle
+        self._states = None
+        self._scan = {}
+        self._next_scan = 0.0
+        self._listen = None
+        self._listen_time = None
+        self.available = os.path.exists(TCP_TABLES[0][0])
+
+    def _scan_tables(self):
+        counts, scanned, queued, truncated = {}, 0, 0, False
+        for path, state_offset in TCP_TABLES:
+            try:
+                lines, waiting = _scan_tcp_table(path, state_offset, counts, self.max_sockets - scanned)
+            except (OSError, ValueError):
+                continue
+            scanned += lines
+            queued += waiting
+            truncated = truncated or scanned >= self.max_sockets
+        self._states = {name: counts.get(code, 0) for code, name in TCP_STATES.items()}
+        self._scan = {"accept_queue": queued, "scanned": scanned, "truncated": truncated}
+
+    def collect(self):
+        if not self.available:
+            return {}
+        now = self.clock.monotonic()
+        if now >= self._next_scan:
+            self._scan_tables()
+            finished = self.clock.monotonic()
+            self._next_scan = finished + (finished - now) * self.duty_cycle
+        tcp = {"states": dict(self._states)}
+        tcp.update(self._scan)
+        sockstat = _read_sockstat()
+        for key, field in (("inuse", "inuse"), ("orphan", "orphan"), ("tw", "time_wait"),
+                           ("alloc", "alloc"), ("mem", "mem_pages")):
+            if key in sockstat:
+                tcp[field] = sockstat[key]
+        listen = _read_listen_counters()
+        tcp.update(listen)
+        elapsed = now - self._listen_time if self._listen_time is not None else 0.0
+        if self._listen is not None and elapsed > 0:
+            for _, key in TCP_LISTEN_COUNTERS:
+                if key in listen and key in self._listen:
+                    # Each one is a dropped packet, so no more than the packet rate.
+                    limit = NETWORK_FALLBACK_MAX_RATE / NETWORK_MIN_FRAME_BYTES * elapsed
+                    delta = counter_delta(self._listen[key], listen[key], limit)
+                    tcp[key + "_per_sec"] = round(delta / elapsed, 2)
+        self._listen, self._listen_time = listen, now
+        return {"tcp": tcp}
+
+def default_collectors(clock=None):
+    return [CpuSampler(clock=clock).collect, collect_memory, collect_disk_usage,
+            FilesystemSampler(clock=clock).collect, DiskIoSampler(clock=clock).collect,
+            NetworkSampler(clock=clock).collect, TcpSampler(clock=clock).collect]
+
+def collect_metrics(collectors):
+    sample = {}
+    for collector in collectors:
+        sample.update(collector())
+    return sample
+
+# --- Shared Sample Buffer ---
+# One sampler thread writes every reading here; the real-time pusher and the
+# aggregator both read from it, so each tick is collected exactly once and
+# both streams see the same numbers.
+class SampleBuffer:
+    def __init__(self, capacity):
+        self._samples = collections.deque(maxlen=capacity)
+        self._cond = threading.Condition()
+        self._seq = 0
+
+    def append(self, sample):
+        with self._cond:
+            self._seq += 1
+            self._samples.append((self._seq, sample))
+            self._cond.notify_all()
+
+    def entries_since(self, last_seq):
+        # (seq, sample) pairs newer than last_seq, oldest first.
+        with self._cond:
+            return [(seq, sample) for seq, sample in self._samples if seq > last_seq]
+
+    def since(self, last_seq):
+        # All retained samples newer than last_seq, oldest first.
+        newer = self.entries_since(last_seq)
+        if not newer:
+            return last_seq, []
+        return newer[-1][0], [sample for _, sample in newer]
+
+# --- Bounded Send Queue ---
+# Sampling and aggregation only ever enqueue; a dedicated sender thread per
+# queue does the HTTP work, so a slow or hung backend cannot delay a tick.
+# When the queue is full the overflow policy decides what gives:
+#   "drop-oldest" - discard the oldest pending item to make room
+#   "coalesce"    - replace the newest pending item with the new one
+#   "block"       - wait up to block_timeout for room, then drop the new item
+OVERFLOW_POLICIES = ("drop-oldest", "coalesce", "block")
+
+class SendQueue:
+    def __init__(self, maxsize, policy="drop-oldest", block_timeout=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self.coalesced = 0
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                if self.policy == "drop-oldest":
+                    self._items.popleft()
+                    self.dropped += 1
+                elif self.policy == "coalesce":
+                    self._items[-1] = item
+                    self.coalesced += 1
+                    return True
+                elif not self._cond.wait_for(
+                    lambda: len(self._items) < self.maxsize, self.block_timeout
+                ):
+                    self.dropped += 1
+                    return False
+            self._items.append(item)
+            self._cond.notify_all()
             return True
+
+    def get(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items, timeout):
+                return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def get_many(self, max_items, timeout=None):
+        # Wait for at least one item, then take up to max_items without waiting.
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items, timeout):
+                return []
+            count = min(max_items, len(self._items))
+            items = [self._items.popleft() for _ in range(count)]
+            self._cond.notify_all()
+            return items
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items)
+
+# --- Gorilla Time-Series Compression ---
+# Column-wise block encoding after Facebook's Gorilla (Pelkonen et al., 2015):
+# integers and timestamps are stored as delta-of-deltas and floats as the XOR
+# with the previous value, both with variable-length bit codes. Regular
+# timestamps and slowly moving percentages then cost a bit or a few each.
+# A block holds rows (dicts) that share one set of keys; strings are run-length
+# encoded in the header. "timestamp" strings are kept to the millisecond.
+#   block  = magic "GRLA", version u8, row count u32, header length u32,
+#            header (JSON: columns, strings, meta), bit stream
+GORILLA_MAGIC = b"GRLA"
+GORILLA_VERSION = 1
+GORILLA_HEADER = struct.Struct("<4sBII")
+GORILLA_TIME_FIELD = "timestamp"
+_FLOAT64 = struct.Struct("<d")
+_UINT64 = struct.Struct("<Q")
+# Delta-of-delta buckets: (control bits, control length, value bits).
+_DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+
+class BitWriter:
+    def __init__(self):
+        self._out = bytearray()
+        self._acc = 0
+        self._bits = 0
+
+    def write(self, value, bits):
+        self._acc = (self._acc << bits) | (value & ((1 << bits) - 1))
+        self._bits += bits
+        while self._bits >= 8:
+            self._bits -= 8
+            self._out.append(self._acc >> self._bits)
+            self._acc &= (1 << self._bits) - 1
+
+    def getvalue(self):
+        if self._bits:
+            return bytes(self._out) + bytes([self._acc << (8 - self._bits)])
+        return bytes(self._out)
+
+class BitReader:
+    def __init__(self, data, position=0):
+        self._data = data
+        self._position = position
+        self._acc = 0
+        self._bits = 0
+
+    def read(self, bits):
+        while self._bits < bits:
+            if self._position >= len(self._data):
+                raise ValueError("bit stream ended early")
+            self._acc = (self._acc << 8) | self._data[self._position]
+            self._position += 1
+            self._bits += 8
+        self._bits -= bits
+        value = self._acc >> self._bits
+        self._acc &= (1 << self._bits) - 1
+        return value
+
+def _signed(value, bits):
+    return value - (1 << bits) if value >= 1 << (bits - 1) else value
+
+def _encode_integers(writer, values):
+    if min(values) < -(1 << 63) or max(values) >= 1 << 63:
+        raise ValueError("integer column out of 64-bit range")
+    previous, delta = values[0], 0
+    writer.write(previous, 64)
+    for value in values[1:]:
+        new_delta = value - previous
+        dod = new_delta - delta
+        previous, delta = value, new_delta
+        if dod == 0:
+            writer.write(0, 1)
+            continue
+        for control, control_bits, bits in _DOD_BUCKETS:
+            if -(1 << (bits - 1)) <= dod < 1 << (bits - 1):
+                writer.write(control, control_bits)
+                writer.write(dod, bits)
+                break
+        else:
+            if not -(1 << 63) <= dod < 1 << 63:
+                raise ValueError("integer column step out of 64-bit range")
+            writer.write(0b1111, 4)
+            writer.write(dod, 64)
+
+def _decode_integers(reader, count):
+    previous, delta = _signed(reader.read(64), 64), 0
+    values = [previous]
+    for _ in range(count - 1):
+        if reader.read(1):
+            # One more set bit per bucket; four set bits mean a full 64-bit step.
+            bits = 64
+            for _, _, bucket_bits in _DOD_BUCKETS:
+                if not reader.read(1):
+                    bits = bucket_bits
+                    break
+            delta += _signed(reader.read(bits), bits)
+        previous += delta
+        values.append(previous)
+    return values
+
+def _encode_floats(writer, values):
+    previous = _UINT64.unpack(_FLOAT64.pack(values[0]))[0]
+    writer.write(previous, 64)
+    leading, trailing = None, None
+    for value in values[1:]:
+        current = _UINT64.unpack(_FLOAT64.pack(value))[0]
+        xor = previous ^ current
+        previous = current
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        new_leading = min(64 - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+        if leading is not None and new_leading >= leading and new_trailing >= trailing:
+            # Fits the previous window of meaningful bits.
+            writer.write(0b10, 2)
+            writer.write(xor >> trailing, 64 - leading - trailing)
         else:
-            print("Failed to create VM:", response.status_code, response.text)
+            leading, trailing = new_leading, new_trailing
+            meaningful = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            writer.write(meaningful & 63, 6)  # 64 meaningful bits is written as 0
+            writer.write(xor >> trailing, meaningful)
+
+def _decode_floats(reader, count):
+    previous = reader.read(64)
+    values = [_FLOAT64.unpack(_UINT64.pack(previous))[0]]
+    leading, trailing = 0, 0
+    for _ in range(count - 1):
+        if reader.read(1):
+            if reader.read(1):
+                leading = reader.read(5)
+                meaningful = reader.read(6) or 64
+                trailing = 64 - leading - meaningful
+            previous ^= reader.read(64 - leading - trailing) << trailing
+        values.append(_FLOAT64.unpack(_UINT64.pack(previous))[0])
+    return values
+
+def _column_kind(name, values):
+    if all(type(value) is str for value in values):
+        return "t" if name == GORILLA_TIME_FIELD else "s"
+    if all(type(value) is int for value in values):
+        return "i"
+    if all(type(value) in (int, float) for value in values):
+        return "d"
+    raise ValueError(f"column {name!r} has no Gorilla encoding")
+
+def encode_columns(rows, meta=None):
+    # Raises ValueError for rows it can't carry; callers store those as they are.
+    if not rows:
+        raise ValueError("no rows to encode")
+    names = list(rows[0])
+    if any(len(row) != len(names) or any(name not in row for name in names) for row in rows):
+        raise ValueError("rows in a block must share one set of keys")
+    writer = BitWriter()
+    columns, strings = [], {}
+    for name in names:
+        values = [row[name] for row in rows]
+        kind = _column_kind(name, values)
+        columns.append([name, kind])
+        if kind == "s":
+            runs = []
+            for value in values:
+                if runs and runs[-1][0] == value:
+                    runs[-1][1] += 1
+                else:
+                    runs.append([value, 1])
+            strings[name] = runs
+        elif kind == "t":
+            _encode_integers(writer, [round(parse_timestamp(value) * 1000) for value in values])
+        elif kind == "i":
+            _encode_integers(writer, values)
+        else:
+            _encode_floats(writer, values)
+    header = json.dumps({"columns": columns, "strings": strings, "meta": meta},
+                        separators=(",", ":")).encode("utf-8")
+    return GORILLA_HEADER.pack(GORILLA_MAGIC, GORILLA_VERSION, len(rows), len(header)) + header + writer.getvalue()
+
+def decode_columns(data):
+    # Returns (rows, meta) for a block written by encode_columns.
+    magic, version, count, header_size = GORILLA_HEADER.unpack_from(data, 0)
+    if magic != GORILLA_MAGIC or version != GORILLA_VERSION:
+        raise ValueError("not a version %d Gorilla block" % GORILLA_VERSION)
+    position = GORILLA_HEADER.size
+    header = json.loads(data[position:position + header_size].decode("utf-8"))
+    reader = BitReader(data, position + header_size)
+    rows = [{} for _ in range(count)]
+    for name, kind in header["columns"]:
+        if kind == "s":
+            values = [value for value, run in header["strings"][name] for _ in range(run)]
+        elif kind == "t":
+            values = [format_timestamp(value / 1000) for value in _decode_integers(reader, count)]
+        elif kind == "i":
+            values = _decode_integers(reader, count)
+        else:
+            values = _decode_floats(reader, count)
+        for row, value in zip(rows, values):
+            row[name] = value
+    return rows, header["meta"]
+
+# --- Durable On-Disk Spool ---
+# Anything the backend could not accept is appended to size-capped segment
+# files and replayed in order once it is reachable again. Each record is
+# framed as <length><crc32><json payload>, so a torn write after a crash is
+# detected and the rest of that segment is discarded; a batch can share one
+# frame as a Gorilla block instead of a JSON payload. Writes are flushed
+# immediately and fsync'd at most every SPOOL_FSYNC_INTERVAL seconds. The
+# segment being replayed is never dropped by the size cap underneath replay.
+SPOOL_DIR = "spool"
+SPOOL_SEGMENT_BYTES = 1024 * 1024       # roll to a new segment after 1 MiB
+SPOOL_MAX_BYTES = 64 * 1024 * 1024      # drop the oldest segments beyond 64 MiB
+SPOOL_FSYNC_INTERVAL = 5                # seconds
+SPOOL_REPLAY_RATE = 1                   # batches per second while catching up
+SPOOL_RETRY_INTERVAL = 30               # seconds between checks for new segments
+SPOOL_FRAME = struct.Struct("<II")
+
+class Spool:
+    def __init__(self, directory, clock=None):
+        self.directory = directory
+        self.clock = clock or SystemClock()
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        segments = self._segment_ids()
+        self._next_id = segments[-1] + 1 if segments else 1
+        self._active = None
+        self._active_id = None
+        self._active_size = 0
+        self._replaying = None  # segment handed out by oldest_segment()
+        self._dirty = False
+        self._last_fsync = self.clock.monotonic()
+
+    def _path(self, segment_id):
+        return os.path.join(self.directory, f"segment-{segment_id:08d}.log")
+
+    def _segment_ids(self):
+        ids = []
+        for name in os.listdir(self.directory):
+            if name.startswith("segment-") and name.endswith(".log"):
+                ids.append(int(name[len("segment-"):-len(".log")]))
+        return sorted(ids)
+
+    def _fsync(self):
+        if self._active is not None and self._dirty:
+            os.fsync(self._active.fileno())
+            self._dirty = False
+        self._last_fsync = self.clock.monotonic()
+
+    def _roll(self):
+        if self._active is not None:
+            self._fsync()
+            self._active.close()
+        self._active_id = self._next_id
+        self._next_id += 1
+        self._active = open(self._path(self._active_id), "ab")
+        self._active_size = 0
+
+    def _enforce_cap(self):
+        sizes = [(i, os.path.getsize(self._path(i))) for i in self._segment_ids()]
+        total = sum(size for _, size in sizes)
+        for segment_id, size in sizes:
+            if total <= SPOOL_MAX_BYTES or segment_id == self._active_id:
+                break
+            if segment_id == self._replaying:
+                continue
+            os.remove(self._path(segment_id))
+            total -= size
+            print(f"Spool over {SPOOL_MAX_BYTES} bytes, dropped oldest segment {segment_id}.")
+
+    def append(self, kind, body):
+        self._write(json.dumps({"kind": kind, "body": body}).encode("utf-8"))
+
+    def append_batch(self, kind, bodies):
+        # Runs of records with the same keys are stored as one Gorilla block;
+        # anything the block encoding can't carry is appended as plain JSON.
+        start = 0
+        while start < len(bodies):
+            end = start + 1
+            while end < len(bodies) and bodies[end].keys() == bodies[start].keys():
+                end += 1
+            try:
+                self._write(encode_columns(bodies[start:end], {"kind": kind}))
+            except (ValueError, TypeError):
+                for body in bodies[start:end]:
+                    self.append(kind, body)
+            start = end
+
+    def _write(self, payload):
+        frame = SPOOL_FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._active is None or self._active_size + len(frame) > SPOOL_SEGMENT_BYTES:
+                self._roll()
+                self._enforce_cap()
+            self._active.write(frame)
+            self._active.flush()
+            self._active_size += len(frame)
+            self._dirty = True
+            if self.clock.monotonic() - self._last_fsync >= SPOOL_FSYNC_INTERVAL:
+                self._fsync()
+
+    def sync(self):
+        with self._lock:
+            if self.clock.monotonic() - self._last_fsync >= SPOOL_FSYNC_INTERVAL:
+                self._fsync()
+
+    def pending(self):
+        with self._lock:
+            return any(
+                i != self._active_id or self._active_size > 0 for i in self._segment_ids()
+            )
+
+    def oldest_segment(self):
+        # Seal the active segment if it is the only one left, so replay never
+        # reads a file that is still being appended to.
+        with self._lock:
+            self._replaying = None
+            for segment_id in self._segment_ids():
+                if segment_id == self._active_id:
+                    if self._active_size == 0:
+                        break
+                    self._roll()
+                self._replaying = segment_id
+                return segment_id
+            return None
+
+    def read_segment(self, segment_id):
+        records = []
+        with open(self._path(segment_id), "rb") as f:
+            while True:
+                header = f.read(SPOOL_FRAME.size)
+                if not header:
+                    break
+                if len(header) < SPOOL_FRAME.size:
+                    print(f"Spool segment {segment_id} has a truncated header, ignoring the rest.")
+                    break
+                length, checksum = SPOOL_FRAME.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    print(f"Spool segment {segment_id} has a corrupt record, ignoring the rest.")
+                    break
+                # The checksum matched, so an undecodable record is skipped
+                # on its own rather than taking the rest of the segment with it.
+                try:
+                    if payload.startswith(GORILLA_MAGIC):
+                        rows, meta = decode_columns(payload)
+                        records.extend((meta["kind"], row) for row in rows)
+                        continue
+                    record = json.loads(payload.decode("utf-8"))
+                    records.append((record["kind"], record["body"]))
+                except (ValueError, KeyError, TypeError, struct.error) as e:
+                    print(f"Spool segment {segment_id} has an undecodable record, skipping it:", e)
+        return records
+
+    def remove(self, segment_id):
+        with self._lock:
+            if segment_id == self._replaying:
+                self._replaying = None
+            try:
+                os.remove(self._path(segment_id))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        with self._lock:
+            if self._active is not None:
+                self._fsync()
+                self._active.close()
+                self._active = None
+
+# --- Streaming Metric Summaries ---
+# Each metric in a window is folded into a constant-size summary: count, min,
+# max, mean and variance (Welford) plus a DDSketch for quantiles. The sketch
+# stores log-spaced bucket counts, so any quantile it returns is within
+# SKETCH_RELATIVE_ACCURACY of the true value, and its size is bounded by
+# SKETCH_MAX_BUCKETS however many samples arrive. Summaries merge exactly,
+# so windows can be combined without revisiting the samples.
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MAX_BUCKETS = 512
+SKETCH_MIN_VALUE = 1e-3  # values at or below this count as zero
+SUMMARY_QUANTILES = (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))
+
+class MetricSummary:
+    def __init__(self):
+        self.gamma = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+        self._log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.mean = 0.0
+        self._m2 = 0.0
+        self._zero_count = 0
+        self._buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if value <= SKETCH_MIN_VALUE:
+            self._zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        if len(self._buckets) > SKETCH_MAX_BUCKETS:
+            self._collapse()
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta * delta * self.count * other.count / total
+        self.mean += delta * other.count / total
+        self.count = total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._zero_count += other._zero_count
+        for index, bucket_count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + bucket_count
+        while len(self._buckets) > SKETCH_MAX_BUCKETS:
+            self._collapse()
+
+    def _collapse(self):
+        # Fold the two lowest buckets together; accuracy is only lost at the
+        # bottom of the range, which the upper percentiles never touch.
+        lowest, second = sorted(self._buckets)[:2]
+        self._buckets[second] += self._buckets.pop(lowest)
+
+    @property
+    def variance(self):
+        return self._m2 / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self._zero_count
+        if rank < seen:
+            return max(self.min, 0.0)
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if rank < seen:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_fields(self, suffix):
+        if self.count == 0:
+            return {}
+        fields = {
+            "avg" + suffix: self.mean,
+            "min" + suffix: self.min,
+            "max" + suffix: self.max,
+            "var" + suffix: self.variance,
+        }
+        for name, q in SUMMARY_QUANTILES:
+            fields[name + suffix] = self.quantile(q)
+        return fields
+
+# --- Multi-Resolution Rollups ---
+# Samples are summarised into wall-clock aligned buckets at several
+# resolutions. Only the finest tier sees raw samples; each closed bucket is
+# merged into the next coarser tier, so every tier is exact and the cost of
+# the coarse ones is negligible. Each tier has its own upload cadence (None
+# keeps it local), letting long-range charts query the coarse rows.
+#   (resolution, bucket width in seconds, upload interval in seconds)
+ROLLUP_TIERS = (
+    ("10s", 10, None),
+    ("1m", 60, 300),
+    ("5m", 300, 300),
+    ("1h", 3600, 3600),
+)
+# (record field suffix, sample field; dotted names reach into nested fields)
+ROLLUP_METRICS = (
+    ("Cpu", "cpu"),
+    ("Memory", "memory"),
+    ("Disk", "disk"),
+    ("DiskRead", "disk_io.read_bytes_per_sec"),
+    ("DiskWrite", "disk_io.write_bytes_per_sec"),
+    ("DiskIops", "disk_io.iops"),
+    ("DiskAwait", "disk_io.await_ms"),
+    ("DiskQueue", "disk_io.queue_depth"),
+    ("NetSent", "network.bytes_sent_per_sec"),
+    ("NetRecv", "network.bytes_recv_per_sec"),
+    ("Steal", "cpu_breakdown.steal"),
+    ("CpuMaxCore", "cpu_breakdown.max_core"),
+)
+
+def sample_value(sample, name):
+    # None when the sample lacks the field, e.g. before a collector's first rate.
+    for key in name.split("."):
+        if not isinstance(sample, dict):
+            return None
+        sample = sample.get(key)
+    return sample
+
+class RollupTier:
+    def __init__(self, resolution, width, upload_interval):
+        self.resolution = resolution
+        self.width = width
+        self.upload_interval = upload_interval
+        self.bucket_start = None
+        self.summaries = None
+        self.sample_count = 0
+        self.pending = []
+        self.next_release = None
+
+    def open(self, start):
+        self.bucket_start = start
+        self.summaries = {suffix: MetricSummary() for suffix, _ in ROLLUP_METRICS}
+        self.sample_count = 0
+
+class Rollups:
+    def __init__(self, vm_id, tiers, boot_id):
+        self.vm_id = vm_id
+        self.boot_id = boot_id
+        self.tiers = [RollupTier(*tier) for tier in tiers]
+        self._seq = 0
+
+    def _bucket(self, level, timestamp):
+        tier = self.tiers[level]
+        start = timestamp - timestamp % tier.width
+        if tier.bucket_start is None:
+            tier.open(start)
+        elif start > tier.bucket_start:
+            self._close(level)
+            tier.open(start)
+        # A sample that arrives late for an already closed bucket is counted in
+        # the current one rather than reopening history.
+
+    def _close(self, level):
+        tier = self.tiers[level]
+        start, summaries, count = tier.bucket_start, tier.summaries, tier.sample_count
+        tier.bucket_start = tier.summaries = None
+        if tier.upload_interval is not None:
+            self._seq += 1
+            record = {"vmId": self.vm_id, "bootId": self.boot_id, "seq": self._seq,
+                      "resolution": tier.resolution}
+            for suffix, summary in summaries.items():
+                record.update(summary.to_fields(suffix))
+            record["sampleCount"] = count
+            record["timestamp"] = format_timestamp(start)
+            tier.pending.append(record)
+        if level + 1 < len(self.tiers):
+            self._bucket(level + 1, start)
+            parent = self.tiers[level + 1]
+            for suffix, summary in summaries.items():
+                parent.summaries[suffix].merge(summary)
+            parent.sample_count += count
+
+    def add_sample(self, sample):
+        self._bucket(0, sample["time"])
+        tier = self.tiers[0]
+        for suffix, key in ROLLUP_METRICS:
+            value = sample_value(sample, key)
+            if value is not None:
+                tier.summaries[suffix].add(value)
+        tier.sample_count += 1
+
+    def advance(self, now):
+        # Close every bucket whose end has passed, finest tier first so each
+        # closure cascades before its parent is checked.
+        for level, tier in enumerate(self.tiers):
+            if tier.bucket_start is not None and tier.bucket_start + tier.width <= now:
+                self._close(level)
+
+    def due_uploads(self, now, force=False):
+        # Hand over a tier's pending records once per upload interval, at this
+        # agent's phase offset within it; force hands over everything.
+        records = []
+        for tier in self.tiers:
+            if tier.upload_interval is None:
+                continue
+            if tier.next_release is None:
+                offset = phase_offset(self.vm_id, tier.upload_interval)
+                tier.next_release = now - now % tier.upload_interval + offset
+            if force or now >= tier.next_release:
+                records.extend(tier.pending)
+                tier.pending = []
+                if tier.next_release <= now:
+                    missed = (now - tier.next_release) // tier.upload_interval + 1
+                    tier.next_release += missed * tier.upload_interval
+        return records
+
+# --- Record Identity ---
+# Every aggregate carries (vmId, bootId, seq): the agent ID, an ID fresh for
+# each agent process, and the record's sequence number within that process.
+# The server keeps a unique index on the triple, so a retried or replayed
+# record it already stored is acknowledged without a second row and delivery
+# can simply be at-least-once. Streamed samples are identified the same way
+# by the boot ID and their sample buffer sequence number. The agent keeps the
+# acknowledged sequence numbers as ranges and never resends those.
+def new_boot_id():
+    return uuid.uuid4().hex
+
+class AckedRanges:
+    def __init__(self):
+        self._ranges = {}  # boot ID -> sorted, disjoint [first, last] ranges
+        self._lock = threading.Lock()
+
+    def add(self, boot_id, seq):
+        with self._lock:
+            ranges = self._ranges.setdefault(boot_id, [])
+            # Index of the first range that starts after seq.
+            i = bisect.bisect_right(ranges, [seq, math.inf])
+            if i > 0 and ranges[i - 1][1] >= seq:
+                return
+            if i > 0 and ranges[i - 1][1] == seq - 1:
+                ranges[i - 1][1] = seq
+                if i < len(ranges) and ranges[i][0] == seq + 1:
+                    ranges[i - 1][1] = ranges[i][1]
+                    del ranges[i]
+            elif i < len(ranges) and ranges[i][0] == seq + 1:
+                ranges[i][0] = seq
+            else:
+                ranges.insert(i, [seq, seq])
+
+    def contains(self, boot_id, seq):
+        if seq is None:
             return False
-    except Exception as e:
-        print("Error creating VM:", e)
+        with self._lock:
+            ranges = self._ranges.get(boot_id, [])
+            i = bisect.bisect_right(ranges, [seq, math.inf])
+            return i > 0 and ranges[i - 1][1] >= seq
+
+    def summary(self):
+        with self._lock:
+            ranges = [r for boot_ranges in self._ranges.values() for r in boot_ranges]
+        return {"ranges": len(ranges), "records": sum(last - first + 1 for first, last in ranges)}
+
+# --- Delta Real-Time Updates ---
+# After the first full PUT, only fields that moved by more than their deadband
+# since the last acknowledged update are PATCHed. When nothing has moved, a
+# small heartbeat still refreshes last_updated; the dashboard marks a VM
+# offline once last_updated is 15s old (OFFLINE_THRESHOLD in Settings.js).
+# The heartbeat is timed on sample time, not on when the last response came
+# back, so request latency can't push it a whole tick late: last_updated
+# values are at most REALTIME_HEARTBEAT_INTERVAL apart, and each arrives
+# within the phase offset (under one SAMPLE_INTERVAL) plus latency after its
+# sample, keeping the dashboard's view under 15s old.
+REALTIME_DELTA_MODE = True
+REALTIME_DEADBAND = {"cpu": 2.0, "memory": 1.0, "disk": 0.5}  # percentage points
+NETWORK_DEADBAND_BYTES = 1024 * 1024
+NETWORK_RATE_DEADBAND = 64 * 1024  # bytes per second
+DISK_IO_DEADBAND_BYTES = 1024 * 1024  # per second, reads plus writes
+DISK_IO_DEADBAND_IOPS = 50
+TCP_DEADBAND_SOCKETS = 50  # per connection state
+CPU_SHARE_DEADBAND = 2.0  # percentage points, per time share and per core
+LOAD_AVG_DEADBAND = 0.5
+CPU_ACTIVITY_DEADBAND = 0.25  # relative change in a context switch or interrupt rate
+CPU_ACTIVITY_FLOOR = 1000     # per second; smaller rates count as this for the deadband
+REALTIME_HEARTBEAT_INTERVAL = 10  # seconds of sample time between last_updated values
+
+# --- Aggregated Performance Data ---
+AGGREGATION_WINDOW = 300  # seconds (5 minutes)
+SAMPLE_INTERVAL = 5       # seconds
+AGGREGATION_INTERVAL = ROLLUP_TIERS[0][1]
+# Hold two aggregation windows so a slow upload never loses samples.
+SAMPLE_BUFFER_SIZE = 2 * AGGREGATION_WINDOW // SAMPLE_INTERVAL
+
+# Only the freshest real-time reading is worth sending, so a backlog collapses
+# into the latest sample. Rollups are kept for up to a day of every uploaded tier.
+REALTIME_QUEUE_SIZE = 1
+REALTIME_OVERFLOW_POLICY = "coalesce"
+PERFORMANCE_QUEUE_SIZE = sum(24 * 3600 // width for _, width, upload in ROLLUP_TIERS if upload)
+PERFORMANCE_OVERFLOW_POLICY = "drop-oldest"
+
+# Largest number of aggregates packed into one bulk request; must not exceed
+# MAX_BULK_RECORDS in routes/performance.js.
+PERFORMANCE_BATCH_SIZE = 500
+
+def is_retryable_status(status_code):
+    return status_code >= 500 or status_code in (401, 408, 429)
+
+# --- Binary Sample Frames ---
+# Performance batches can go out as a versioned, struct-packed frame instead
+# of JSON: key names become one-byte field IDs, numbers travel as raw
+# float64/uint32 and timestamps as epoch milliseconds. The server accepts
+# both (middleware/decompress.js); an older server that rejects a frame puts
+# the agent back on JSON. Run `python vm_agent.py --benchmark` to compare the
+# codecs on this machine.
+#   frame  = header record*
+#   header = magic "VMAF", version u8, record count u16
+#   record = field count u8, (field id u8, value)*
+#   value  = string: length u8 + UTF-8 | float64 | uint32, by field ID
+WIRE_FORMAT = "json"   # "json" or "frame"
+FRAME_CONTENT_TYPE = "application/vnd.vm-agent.frame"
+FRAME_MAGIC = b"VMAF"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<4sBH")
+# Field IDs are part of the wire format: never renumber, only append. Summary
+# statistics get a block of eight IDs per metric starting at 16.
+FRAME_STATS = ("avg", "min", "max", "var", "p50", "p95", "p99")
+FRAME_FIELDS = {
+    "vmId": (1, "s"), "resolution": (2, "s"), "timestamp": (3, "t"), "sampleCount": (4, "I"),
+    "bootId": (5, "s"), "seq": (6, "I"),
+}
+FRAME_FIELDS.update({
+    prefix + suffix: (16 + 8 * metric + stat, "d")
+    for metric, (suffix, _) in enumerate(ROLLUP_METRICS)
+    for stat, prefix in enumerate(FRAME_STATS)
+})
+FRAME_FIELD_NAMES = {field_id: (name, kind) for name, (field_id, kind) in FRAME_FIELDS.items()}
+_FRAME_BYTE = struct.Struct("<B")
+_FRAME_PACKERS = {"d": struct.Struct("<d"), "t": struct.Struct("<d"), "I": struct.Struct("<I")}
+
+def encode_frame(records):
+    # Raises ValueError for records the frame can't carry; callers send those as JSON.
+    if len(records) > 0xFFFF:
+        raise ValueError("too many records for one frame")
+    parts = [FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, len(records))]
+    for record in records:
+        parts.append(_FRAME_BYTE.pack(len(record)))
+        for name, value in record.items():
+            if name not in FRAME_FIELDS:
+                raise ValueError(f"no frame field for {name!r}")
+            field_id, kind = FRAME_FIELDS[name]
+            parts.append(_FRAME_BYTE.pack(field_id))
+            if kind == "s":
+                data = value.encode("utf-8")
+                parts.append(_FRAME_BYTE.pack(len(data)))
+                parts.append(data)
+            elif kind == "t":
+                parts.append(_FRAME_PACKERS[kind].pack(round(parse_timestamp(value) * 1000)))
+            else:
+                parts.append(_FRAME_PACKERS[kind].pack(value))
+    return b"".join(parts)
+
+def decode_frame(data):
+    magic, version, count = FRAME_HEADER.unpack_from(data, 0)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError("not a version %d sample frame" % FRAME_VERSION)
+    position = FRAME_HEADER.size
+    records = []
+    for _ in range(count):
+        fields = data[position]
+        position += 1
+        record = {}
+        for _ in range(fields):
+            name, kind = FRAME_FIELD_NAMES[data[position]]
+            position += 1
+            if kind == "s":
+                length = data[position]
+                record[name] = data[position + 1:position + 1 + length].decode("utf-8")
+                position += 1 + length
+            else:
+                packer = _FRAME_PACKERS[kind]
+                value, = packer.unpack_from(data, position)
+                position += packer.size
+                record[name] = format_timestamp(value / 1000) if kind == "t" else value
+        records.append(record)
+    return records
+
+# --- Payload Compression ---
+# Request bodies at or above COMPRESSION_THRESHOLD are compressed and sent
+# with a Content-Encoding header; express.json() inflates gzip on the server
+# and middleware/decompress.js handles zstd. Small bodies, like real-time
+# deltas, go out as-is since compressing them costs more than it saves. The
+# encoder keeps running totals of bytes saved and CPU spent for stats().
+COMPRESSION_ALGORITHM = "gzip"   # "gzip", "zstd" (needs zstandard) or None
+COMPRESSION_THRESHOLD = 1024     # bytes
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Per-thread CPU time where available, so other threads' work isn't counted.
+_thread_time = getattr(time, "thread_time", time.process_time)
+
+class PayloadEncoder:
+    def __init__(self, algorithm=COMPRESSION_ALGORITHM, threshold=COMPRESSION_THRESHOLD,
+                 wire_format=WIRE_FORMAT):
+        if algorithm == "zstd" and zstandard is None:
+            print("zstandard is not installed, using gzip compression instead.")
+            algorithm = "gzip"
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.wire_format = wire_format
+        self._lock = threading.Lock()
+        self._totals = {"bodies": 0, "frames": 0, "compressed": 0, "raw_bytes": 0, "sent_bytes": 0,
+                        "cpu_seconds": 0.0}
+
+    def encode(self, payload, records=None):
+        # records marks a bulk body ({"records": [...]}) that may go as a frame.
+        data = None
+        if records is not None and self.wire_format == "frame":
+            try:
+                data = encode_frame(records)
+                headers = {"Content-Type": FRAME_CONTENT_TYPE}
+            except (ValueError, TypeError, struct.error) as e:
+                print("Sending batch as JSON, it does not fit a sample frame:", e)
+        if data is None:
+            data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+            headers = {"Content-Type": "application/json"}
+        raw_size = len(data)
+        cpu_seconds = 0.0
+        algorithm = self.algorithm
+        if algorithm and raw_size >= self.threshold:
+            started = _thread_time()
+            if algorithm == "zstd":
+                data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+            else:
+                data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+            cpu_seconds = _thread_time() - started
+            headers["Content-Encoding"] = algorithm
+        with self._lock:
+            self._totals["bodies"] += 1
+            self._totals["frames"] += headers["Content-Type"] == FRAME_CONTENT_TYPE
+            self._totals["compressed"] += "Content-Encoding" in headers
+            self._totals["raw_bytes"] += raw_size
+            self._totals["sent_bytes"] += len(data)
+            self._totals["cpu_seconds"] += cpu_seconds
+        return data, headers
+
+    def fall_back(self, status_code, framed):
+        # Step down one encoding after the server refused a body; returns
+        # whether there was anything left to try. zstd falls back to gzip,
+        # which is always understood (415). Frames fall back to JSON; servers
+        # that predate them answer 400, as their JSON parser leaves the body
+        # empty.
+        if status_code == 415 and self.algorithm == "zstd":
+            print("Server does not accept zstd bodies, switching to gzip.")
+            self.algorithm = "gzip"
+            return True
+        if framed and status_code in (400, 415) and self.wire_format == "frame":
+            print("Server does not accept sample frames, switching to JSON.")
+            self.wire_format = "json"
+            return True
         return False
 
-def update_realtime():
-    while True:
-        data = collect_metrics()
-        realtime_data = {
-            "_id": agent_id,
-            "name": host_name,
-            "os": os_type,
+    def summary(self):
+        with self._lock:
+            totals = dict(self._totals)
+        totals["algorithm"] = self.algorithm
+        totals["wire_format"] = self.wire_format
+        totals["ratio"] = totals["raw_bytes"] / totals["sent_bytes"] if totals["sent_bytes"] else 1.0
+        return totals
+
+# --- Real-Time Streaming Channel ---
+# With websocket-client installed, real-time samples go over one long-lived
+# WebSocket (routes/agentStream.js) instead of an HTTP request per tick. The
+# agent says hello with its ID and boot ID (see Record Identity), the server
+# answers with the last sequence number it applied, and the agent resends
+# everything newer from the shared sample buffer, so a reconnect loses
+# nothing the buffer still holds. Each sample is an 88-byte binary message
+# behind a 6-byte WebSocket header carrying the fields in STREAMED_FIELDS plus
+# disk I/O and network rate totals. Everything else (the CPU breakdown,
+# filesystems, TCP, the per-device and per-interface figures) is still
+# PATCHed over HTTP whenever it moves past its deadband. Whenever the stream
+# is down, that tick falls back to the HTTP path while reconnects back off.
+# The server acknowledges each sample once it is stored. A connection that
+# dies silently (an idle NAT or load balancer drop, a server gone without a
+# FIN) would otherwise keep swallowing sends for minutes, so a sample left
+# unacknowledged for STREAM_ACK_TIMEOUT marks the stream down, and the HTTP
+# baseline only counts acknowledged samples as delivered.
+REALTIME_STREAMING = True
+STREAM_URL = API_ROOT.replace("https://", "wss://", 1).replace("http://", "ws://", 1) + "/agent-stream"
+STREAM_RETRY_MAX_DELAY = 300  # seconds
+STREAM_ACK_TIMEOUT = 8  # seconds; acks normally arrive well before the next tick
+# seq, time, cpu, memory, disk, bytes_sent, bytes_recv, packets_sent, packets_recv,
+# then disk I/O read/write bytes per second, IOPS and queue depth, then network
+# bytes and packets sent/received per second (NaN where unknown)
+STREAM_SAMPLE = struct.Struct("<Idfffddddffffffff")
+STREAM_DISK_IO_FIELDS = ("read_bytes_per_sec", "write_bytes_per_sec", "iops", "queue_depth")
+STREAM_NETWORK_RATE_FIELDS = ("bytes_sent_per_sec", "bytes_recv_per_sec",
+                              "packets_sent_per_sec", "packets_recv_per_sec")
+STREAMED_FIELDS = ("cpu", "memory", "disk", "network", "last_updated")
+
+class SampleStream:
+    def __init__(self, url=STREAM_URL, timeout=READ_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self._conn = None
+
+    def connected(self):
+        return self._conn is not None
+
+    def connect(self, token, hello):
+        # Returns the last sequence number the server applied for this boot ID.
+        self.close()
+        conn = websocket.create_connection(self.url, timeout=self.timeout,
+                                           header=["Authorization: Bearer " + token])
+        try:
+            conn.send(json.dumps(hello))
+            reply = json.loads(conn.recv())
+        except Exception:
+            conn.close()
+            raise
+        self._conn = conn
+        return reply.get("seq", 0)
+
+    def poll(self):
+        # Reads whatever the server has sent so far without waiting. Returns
+        # the highest sequence number acknowledged, or None; raises once the
+        # server has closed the stream.
+        acked = None
+        while self._readable():
+            opcode, frame = self._conn.recv_data_frame(True)
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                code = struct.unpack("!H", frame.data[:2])[0] if len(frame.data) >= 2 else None
+                raise ConnectionError(f"closed by server ({code} {frame.data[2:].decode('utf-8', 'replace')})")
+            if opcode == websocket.ABNF.OPCODE_TEXT:
+                message = json.loads(frame.data)
+                if message.get("type") == "ack":
+                    acked = max(acked or 0, message["seq"])
+        return acked
+
+    def _readable(self):
+        sock = self._conn.sock
+        if sock is None:
+            raise ConnectionError("connection closed")
+        # TLS can hold decrypted bytes that select() doesn't see.
+        if hasattr(sock, "pending") and sock.pending():
+            return True
+        return bool(select.select([sock], [], [], 0)[0])
+
+    def send(self, seq, sample):
+        network = sample["network"]
+        disk_io = sample.get("disk_io") or {}
+        self._conn.send_binary(STREAM_SAMPLE.pack(
+            seq, sample["time"], sample["cpu"], sample["memory"], sample["disk"],
+            network["bytes_sent"], network["bytes_recv"], network["packets_sent"], network["packets_recv"],
+            *([disk_io.get(field, math.nan) for field in STREAM_DISK_IO_FIELDS]
+              + [network.get(field, math.nan) for field in STREAM_NETWORK_RATE_FIELDS])
+        ))
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+# --- Retry Policy and Circuit Breaker ---
+# Failed uploads back off exponentially with full jitter (a random delay
+# between zero and the capped exponential), so a recovering backend is not
+# hit by the whole fleet on the same beat; a Retry-After header extends the
+# delay. Each upload channel backs off on its own, while one circuit breaker
+# per backend opens after repeated failures and stops all uploads until a
+# single probe succeeds. Sampling carries on either way.
+RETRY_BASE_DELAY = 1              # seconds
+RETRY_MAX_DELAY = 300             # seconds
+REALTIME_RETRY_MAX_DELAY = 60     # seconds; keeps a recovered VM from looking offline for long
+BREAKER_FAILURE_THRESHOLD = 5     # consecutive failures before the breaker opens
+BREAKER_RESET_TIMEOUT = 60        # seconds the breaker stays open before a probe
+
+class BackendUnavailable(Exception):
+    pass
+
+def is_backend_failure(status_code):
+    return status_code >= 500 or status_code in (408, 429)
+
+def parse_retry_after(response, clock=None):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=datetime.timezone.utc)
+        now = clock.time() if clock is not None else time.time()
+        return max(when.timestamp() - now, 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class Backoff:
+    def __init__(self, clock, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+        self.clock = clock
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+        self._next_attempt = 0.0
+
+    def remaining(self):
+        return max(self._next_attempt - self.clock.monotonic(), 0.0)
+
+    def record_success(self):
+        self.failures = 0
+        self._next_attempt = 0.0
+
+    def record_failure(self, retry_after=None):
+        self.failures += 1
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** (self.failures - 1)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.cap))
+        self._next_attempt = self.clock.monotonic() + delay
+
+class CircuitBreaker:
+    def __init__(self, clock, threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.clock = clock
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        if self.state != "open":
+            return 0.0
+        return max(self._opened_at + self.reset_timeout - self.clock.monotonic(), 0.0)
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and self.remaining() == 0:
+                # Let exactly one probe through; everyone else waits for its result.
+                self.state = "half-open"
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print("Backend reachable again, resuming uploads.")
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or (self.state == "closed" and self.failures >= self.threshold):
+                print(f"Backend failing, pausing uploads for {self.reset_timeout}s.")
+                self.state = "open"
+                self._opened_at = self.clock.monotonic()
+
+# --- Agent ---
+# All monitoring state lives on an Agent instance, so importing this module
+# has no side effects and an agent can be embedded, benchmarked or run
+# headless. Collectors, transport and clock are injectable; start() launches
+# the loops and stop() shuts them down, spooling anything not yet delivered.
+QUEUE_POLL_INTERVAL = 1  # seconds; how quickly sender threads notice stop()
+STATS_REPORT_INTERVAL = 3600  # seconds between one-line stats summaries
+
+class Agent:
+    def __init__(self, email, token, password=None, agent_id=None, collectors=None,
+                 transport=None, clock=None, spool_dir=SPOOL_DIR, stream=None):
+        self.email = email
+        self.token = token
+        self.password = password  # only needed to log in again if refresh fails
+        self.agent_id = agent_id  # read from or written to agent_id.txt by start() if not given
+        self.host_name = socket.gethostname()
+        self.os_type = platform.system()
+        self.clock = clock or SystemClock()
+        self.collectors = collectors if collectors is not None else default_collectors(self.clock)
+        self.transport = transport or HttpTransport()
+        self.spool_dir = spool_dir
+        self.spool = None  # opened by start(), so constructing an agent touches no files
+        self.scheduler_stats = {}
+        self.sample_buffer = SampleBuffer(SAMPLE_BUFFER_SIZE)
+        self.realtime_queue = SendQueue(REALTIME_QUEUE_SIZE, REALTIME_OVERFLOW_POLICY)
+        self.performance_queue = SendQueue(PERFORMANCE_QUEUE_SIZE, PERFORMANCE_OVERFLOW_POLICY)
+        self.boot_id = new_boot_id()
+        self.rollups = Rollups(self.agent_id, ROLLUP_TIERS, self.boot_id)
+        self.acked = AckedRanges()
+        self.spool_senders = {"performance": self.send_performance}
+        if stream is None and REALTIME_STREAMING and websocket is not None:
+            stream = SampleStream()
+        self.stream = stream
+        self._stream_seq = 0
+        self._stream_unacked = collections.deque()  # (seq, monotonic send time, sample)
+        self._aggregation_seq = 0
+        self._registered = False      # whether the backend is known to hold our VM record
+        self._realtime_state = None   # field values as last acknowledged by the backend
+        self._realtime_sent_time = None  # sample time of the last last_updated sent
+        self.encoder = PayloadEncoder()
+        self.breaker = CircuitBreaker(self.clock)
+        self.backoffs = {
+            "realtime": Backoff(self.clock, cap=REALTIME_RETRY_MAX_DELAY),
+            "performance": Backoff(self.clock),
+            "stream": Backoff(self.clock, cap=STREAM_RETRY_MAX_DELAY),
+        }
+        self._stopped = threading.Event()
+        self._refresh_now = threading.Event()
+        self._threads = []
+
+    @property
+    def vm_url(self):
+        return f"{API_BASE_URL}/{self.agent_id}"
+
+    def _auth_headers(self):
+        return {"Authorization": "Bearer " + self.token}
+
+    def _request(self, channel, method, url, **kwargs):
+        # Every upload goes through here so it honours the channel's backoff
+        # and the shared circuit breaker. Raises BackendUnavailable when the
+        # call is not attempted.
+        backoff = self.backoffs[channel]
+        if backoff.remaining() > 0 or not self.breaker.allow():
+            raise BackendUnavailable(f"{channel} uploads paused")
+        payload = kwargs.pop("json", None)
+        records = kwargs.pop("records", None)
+        try:
+            response, framed = self._send(method, url, payload, records, **kwargs)
+            while self.encoder.fall_back(response.status_code, framed):
+                response, framed = self._send(method, url, payload, records, **kwargs)
+        except Exception:
+            backoff.record_failure()
+            self.breaker.record_failure()
+            raise
+        if is_backend_failure(response.status_code):
+            backoff.record_failure(parse_retry_after(response, self.clock))
+            self.breaker.record_failure()
+        else:
+            backoff.record_success()
+            self.breaker.record_success()
+        # A 401 means the token lapsed early (e.g. the host slept); renew now.
+        if response.status_code == 401:
+            self._refresh_now.set()
+        return response
+
+    def _send(self, method, url, payload, records=None, **kwargs):
+        # Returns the response and whether the body went out as a sample frame.
+        headers = self._auth_headers()
+        if payload is not None:
+            kwargs["data"], content_headers = self.encoder.encode(payload, records)
+            headers.update(content_headers)
+        response = self.transport.request(method, url, headers=headers, **kwargs)
+        return response, headers.get("Content-Type") == FRAME_CONTENT_TYPE
+
+    def _retry_delay(self, channel):
+        return max(self.backoffs[channel].remaining(), self.breaker.remaining())
+
+    # --- Lifecycle ---
+    def start(self):
+        if self.agent_id is None:
+            self.agent_id = self.rollups.vm_id = get_agent_id()
+        self.spool = Spool(self.spool_dir, self.clock)
+        self._stopped.clear()
+        loops = [
+            (run_every, ("sampler", SAMPLE_INTERVAL, self.sample_metrics, self._stopped,
+                         True, self.clock, self.scheduler_stats)),
+            # Aggregation and real-time uploads run at this agent's phase
+            # offset, which also keeps them clear of the sampling instant.
+            (run_every, ("aggregation", AGGREGATION_INTERVAL, self.aggregate_metrics, self._stopped,
+                         True, self.clock, self.scheduler_stats,
+                         phase_offset(self.agent_id, AGGREGATION_INTERVAL))),
+            (run_every, ("realtime", SAMPLE_INTERVAL, self.update_realtime, self._stopped,
+                         True, self.clock, self.scheduler_stats,
+                         phase_offset(self.agent_id, SAMPLE_INTERVAL))),
+            (self.aggregate_and_send, ()),
+            (self.replay_spool, ()),
+            (self.refresh_token_loop, ()),
+            # The first report comes one interval in, not at startup.
+            (run_every, ("stats", STATS_REPORT_INTERVAL, self.report_stats, self._stopped,
+                         False, self.clock, self.scheduler_stats, STATS_REPORT_INTERVAL)),
+        ]
+        self._threads = [threading.Thread(target=target, args=args, daemon=True) for target, args in loops]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=10):
+        self._stopped.set()
+        self._refresh_now.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        # Nothing queued or rolled up but not yet due is lost on shutdown.
+        pending = self.performance_queue.get_many(PERFORMANCE_QUEUE_SIZE, timeout=0)
+        pending.extend(self.rollups.due_uploads(self.clock.time(), force=True))
+        if self.spool is not None:
+            self.spool.append_batch("performance", pending)
+            self.spool.close()
+        if self.stream is not None:
+            self.stream.close()
+        self.transport.close()
+
+    # --- Stats ---
+    def stats(self):
+        queues = {}
+        for name, queue in (("realtime", self.realtime_queue), ("performance", self.performance_queue)):
+            queues[name] = {"pending": len(queue), "dropped": queue.dropped, "coalesced": queue.coalesced}
+        return {
+            "scheduler": {name: dict(values) for name, values in self.scheduler_stats.items()},
+            "queues": queues,
+            "compression": self.encoder.summary(),
+            "breaker": self.breaker.state,
+            "acked": self.acked.summary(),
+            "stream": "off" if self.stream is None else ("connected" if self.stream.connected() else "down"),
+        }
+
+    def report_stats(self, lateness):
+        stats = self.stats()
+        compression = stats["compression"]
+        sampler = stats["scheduler"].get("sampler", {})
+        print(
+            f"Agent stats: {sampler.get('ticks', 0)} samples "
+            f"(max lateness {sampler.get('max_lateness', 0.0):.3f}s), "
+            f"{compression['bodies']} uploads ({compression['frames']} framed), {compression['raw_bytes']} -> {compression['sent_bytes']} bytes "
+            f"({compression['algorithm']} ratio {compression['ratio']:.2f}, "
+            f"{compression['cpu_seconds'] * 1000:.1f}ms CPU), breaker {stats['breaker']}."
+        )
+
+    # --- Sampling and Aggregation ---
+    def sample_metrics(self, lateness):
+        sample = collect_metrics(self.collectors)
+        sample["time"] = self.clock.time()
+        sample["timestamp"] = format_timestamp(sample["time"])
+        sample["tick_lateness"] = round(lateness, 3)
+        self.sample_buffer.append(sample)
+        self.realtime_queue.put(sample)
+
+    def aggregate_metrics(self, lateness):
+        self._aggregation_seq, samples = self.sample_buffer.since(self._aggregation_seq)
+        for sample in samples:
+            self.rollups.add_sample(sample)
+        self.rollups.advance(self.clock.time())
+        for record in self.rollups.due_uploads(self.clock.time()):
+            self.performance_queue.put(record)
+
+    # --- Real-Time Updates ---
+    def build_full_update(self, data):
+        update = {
+            "_id": self.agent_id,
+            "name": self.host_name,
+            "os": self.os_type,
             "cpu": data["cpu"],
             "memory": data["memory"],
             "disk": data["disk"],
-            "network": {
-                "bytes_sent": psutil.net_io_counters().bytes_sent,
-                "bytes_recv": psutil.net_io_counters().bytes_recv,
-                "packets_sent": psutil.net_io_counters().packets_sent,
-                "packets_recv": psutil.net_io_counters().packets_recv,
-            },
+            "network": data["network"],
             "status": "Running",
-            "last_updated": get_current_timestamp(),
-            "user": USER_EMAIL
+            "last_updated": data["timestamp"],
+            "user": self.email
         }
-        headers = {"Authorization": "Bearer " + USER_TOKEN}
+        for field in ("cpu_breakdown", "load_avg", "cpu_activity", "disk_io", "filesystems", "tcp"):
+            if field in data:
+                update[field] = data[field]
+        return update
+
+    def build_delta_update(self, data, streamed=False):
+        # With streamed=True the stream has already delivered this sample's
+        # STREAMED_FIELDS, so only what it cannot carry is checked, and no
+        # heartbeat is needed.
+        changed = {}
+        if not streamed:
+            for field, deadband in REALTIME_DEADBAND.items():
+                if abs(data[field] - self._realtime_state[field]) >= deadband:
+                    changed[field] = data[field]
+        network, last_network = data["network"], self._realtime_state["network"]
+        if ((not streamed and (
+                any(abs(network[k] - last_network[k]) >= NETWORK_DEADBAND_BYTES for k in ("bytes_sent", "bytes_recv"))
+                or any(abs(network.get(k, 0.0) - last_network.get(k, 0.0)) >= NETWORK_RATE_DEADBAND
+                       for k in ("bytes_sent_per_sec", "bytes_recv_per_sec"))))
+                or self._interfaces_moved(network.get("interfaces"), last_network.get("interfaces"))):
+            changed["network"] = network
+        if "cpu_breakdown" in data and self._cpu_breakdown_moved(data["cpu_breakdown"], self._realtime_state.get("cpu_breakdown")):
+            changed["cpu_breakdown"] = data["cpu_breakdown"]
+        last_load = self._realtime_state.get("load_avg")
+        if "load_avg" in data and (last_load is None or any(
+                abs(load - before) >= LOAD_AVG_DEADBAND for load, before in zip(data["load_avg"], last_load))):
+            changed["load_avg"] = data["load_avg"]
+        last_activity = self._realtime_state.get("cpu_activity")
+        if "cpu_activity" in data and (last_activity is None or any(
+                abs(rate - last_activity.get(field, 0.0))
+                >= CPU_ACTIVITY_DEADBAND * max(last_activity.get(field, 0.0), CPU_ACTIVITY_FLOOR)
+                for field, rate in data["cpu_activity"].items())):
+            changed["cpu_activity"] = data["cpu_activity"]
+        if "disk_io" in data and self._disk_io_moved(data["disk_io"], self._realtime_state.get("disk_io")):
+            changed["disk_io"] = data["disk_io"]
+        if "filesystems" in data and self._filesystems_moved(data["filesystems"], self._realtime_state.get("filesystems")):
+            changed["filesystems"] = data["filesystems"]
+        if "tcp" in data and self._tcp_moved(data["tcp"], self._realtime_state.get("tcp")):
+            changed["tcp"] = data["tcp"]
+        # Half a sample interval of slack, so a tick whose sample lands a
+        # little early still counts as due.
+        heartbeat_due = (self._realtime_sent_time is None or data["time"] - self._realtime_sent_time
+                         >= REALTIME_HEARTBEAT_INTERVAL - SAMPLE_INTERVAL / 2)
+        if not changed and (streamed or not heartbeat_due):
+            return None
+        changed["last_updated"] = data["timestamp"]
+        return changed
+
+    def _cpu_breakdown_moved(self, breakdown, last):
+        # A time share or any core's busy percentage moved past the deadband,
+        # or the core count changed.
+        if last is None:
+            return True
+        if any(abs(breakdown[field] - last.get(field, 0.0)) >= CPU_SHARE_DEADBAND for field in CPU_BREAKDOWN_FIELDS):
+            return True
+        cores, last_cores = breakdown["per_core"], last.get("per_core", [])
+        return len(cores) != len(last_cores) or any(
+            abs(busy - before) >= CPU_SHARE_DEADBAND for busy, before in zip(cores, last_cores))
+
+    def _interfaces_moved(self, interfaces, last):
+        # An interface appeared or vanished, or its throughput moved past the deadband.
+        if interfaces is None:
+            return False
+        if last is None:
+            return True
+        previous = {nic["name"]: nic for nic in last}
+        if set(previous) != {nic["name"] for nic in interfaces}:
+            return True
+        return any(abs(nic[k] - previous[nic["name"]].get(k, 0.0)) >= NETWORK_RATE_DEADBAND
+                   for nic in interfaces for k in ("bytes_sent_per_sec", "bytes_recv_per_sec"))
+
+    def _disk_io_moved(self, disk_io, last):
+        # Totals or any one device's throughput or IOPS moved past the
+        # deadband, or a device appeared or vanished.
+        if last is None:
+            return True
+        if (abs(disk_io["read_bytes_per_sec"] + disk_io["write_bytes_per_sec"]
+                - last["read_bytes_per_sec"] - last["write_bytes_per_sec"]) >= DISK_IO_DEADBAND_BYTES
+                or abs(disk_io["iops"] - last["iops"]) >= DISK_IO_DEADBAND_IOPS):
+            return True
+        previous = {device["device"]: device for device in last.get("devices", [])}
+        devices = disk_io.get("devices", [])
+        if set(previous) != {device["device"] for device in devices}:
+            return True
+        for device in devices:
+            before = previous[device["device"]]
+            if (abs(device["read_bytes_per_sec"] + device["write_bytes_per_sec"]
+                    - before["read_bytes_per_sec"] - before["write_bytes_per_sec"]) >= DISK_IO_DEADBAND_BYTES
+                    or abs(device["read_iops"] + device["write_iops"]
+                           - before["read_iops"] - before["write_iops"]) >= DISK_IO_DEADBAND_IOPS):
+                return True
+        return False
+
+    def _filesystems_moved(self, filesystems, last):
+        # A mount appeared, vanished, hung or recovered, or filled past the deadband.
+        if last is None:
+            return True
+        previous = {fs["mount"]: fs for fs in last}
+        if set(previous) != {fs["mount"] for fs in filesystems}:
+            return True
+        deadband = REALTIME_DEADBAND["disk"]
+        for fs in filesystems:
+            before = previous[fs["mount"]]
+            if fs["hung"] != before["hung"]:
+                return True
+            for field in ("percent", "inodes_percent"):
+                if field in fs and abs(fs[field] - before.get(field, 0.0)) >= deadband:
+                    return True
+        return False
+
+    def _tcp_moved(self, tcp, last):
+        # A state count moved past the deadband, or a listen queue overflowed.
+        if last is None:
+            return True
+        if any(abs(count - last["states"].get(state, 0)) >= TCP_DEADBAND_SOCKETS
+               for state, count in tcp["states"].items()):
+            return True
+        return any(tcp.get(key) != last.get(key) for _, key in TCP_LISTEN_COUNTERS)
+
+    def remember_realtime_update(self, update, sample_time):
+        self._realtime_state = dict(self._realtime_state or {}, **update)
+        self._realtime_sent_time = sample_time
+
+    # --- VM Registration ---
+    # A single idempotent upsert creates the VM record if it is missing and
+    # otherwise overwrites it with a full update. Once it succeeds the agent
+    # only PATCHes deltas, until a 404 says the record has been deleted.
+    def register_vm(self, data):
+        vm_data = self.build_full_update(data)
         try:
-            response = requests.put(API_URL, json=realtime_data, headers=headers)
+            response = self._request("realtime", "PUT", self.vm_url, params={"upsert": "true"}, json=vm_data)
             if response.status_code in (200, 201):
+                if not self._registered:
+                    print("VM registered with the dashboard.")
+                self._registered = True
+                self.remember_realtime_update(vm_data, data["time"])
+                print("Real-time metrics updated successfully.")
+                return True
+            print("Failed to register VM:", response.status_code, response.text)
+        except BackendUnavailable:
+            pass
+        except Exception as e:
+            print("Error registering VM:", e)
+        return False
+
+    def update_realtime(self, lateness):
+        data = self.realtime_queue.get(timeout=0)
+        if data is None:
+            return
+        if not self._registered or not REALTIME_DELTA_MODE:
+            self.register_vm(data)
+            return
+        # While streaming, fields the stream does not carry (CPU breakdown,
+        # filesystems, TCP, per-device and per-interface figures) still go by
+        # HTTP when they move.
+        streamed = self.stream is not None and self.stream_samples()
+        realtime_data = self.build_delta_update(data, streamed)
+        if realtime_data is None:
+            return
+        try:
+            response = self._request("realtime", "PATCH", self.vm_url, json=realtime_data)
+            if response.status_code in (200, 201, 204):
+                self.remember_realtime_update(realtime_data, data["time"])
                 print("Real-time metrics updated successfully.")
             elif response.status_code == 404:
-                print("VM not found, attempting to create a new record...")
-                if create_vm():
-                    print("New VM record created, retrying update...")
-                    response = requests.put(API_URL, json=realtime_data, headers=headers)
-                    if response.status_code in (200, 201):
-                        print("Real-time metrics updated successfully after creation.")
-                    else:
-                        print("Failed to update VM after creation:", response.status_code, response.text)
-                else:
-                    print("Unable to create new VM record.")
+                print("VM record missing, registering it again...")
+                self._registered = False
+                self.register_vm(data)
             else:
                 print("Failed to update real-time metrics:", response.status_code, response.text)
+        except BackendUnavailable:
+            # Skip this tick; a fresher sample will be along shortly.
+            pass
         except Exception as e:
             print("Error updating real-time metrics:", e)
-        time.sleep(5)
 
-# --- Aggregated Performance Data ---
-AGGREGATION_WINDOW = 300  # seconds (5 minutes)
-SAMPLE_INTERVAL = 5       # seconds
+    # --- Real-Time Streaming ---
+    # Returns False when this tick should go over HTTP instead.
+    def stream_samples(self):
+        backoff = self.backoffs["stream"]
+        if not self.stream.connected():
+            if backoff.remaining() > 0:
+                return False
+            # The boot ID tells the server a restarted agent from a reconnect.
+            hello = {"agentId": self.agent_id, "bootId": self.boot_id}
+            try:
+                self._stream_seq = self.stream.connect(self.token, hello)
+            except Exception as e:
+                if backoff.failures == 0:
+                    print("Real-time stream unavailable, using HTTP updates:", e)
+                backoff.record_failure()
+                return False
+            backoff.record_success()
+            self._stream_unacked.clear()
+            print(f"Streaming real-time metrics (resuming after sample {self._stream_seq}).")
+        now = self.clock.monotonic()
+        try:
+            acked = self.stream.poll()
+            if acked is not None:
+                self._stream_acked(acked)
+            if self._stream_unacked and now - self._stream_unacked[0][1] > STREAM_ACK_TIMEOUT:
+                raise ConnectionError(f"sample {self._stream_unacked[0][0]} unacknowledged for {STREAM_ACK_TIMEOUT}s")
+            for seq, sample in self.sample_buffer.entries_since(self._stream_seq):
+                self.stream.send(seq, sample)
+                self._stream_seq = seq
+                self._stream_unacked.append((seq, now, sample))
+        except Exception as e:
+            print("Real-time stream dropped, using HTTP updates until it reconnects:", e)
+            self.stream.close()
+            backoff.record_failure()
+            return False
+        return True
 
-def aggregate_and_send():
-    while True:
-        samples = []
-        start_time = time.time()
-        print("Starting aggregation for a 5-minute window...")
-        while time.time() - start_time < AGGREGATION_WINDOW:
-            sample = collect_metrics()
-            samples.append(sample)
-            time.sleep(SAMPLE_INTERVAL)
-        if samples:
-            avgCpu = sum(s['cpu'] for s in samples) / len(samples)
-            avgMemory = sum(s['memory'] for s in samples) / len(samples)
-            avgDisk = sum(s['disk'] for s in samples) / len(samples)
-            aggregatedData = {
-                "vmId": agent_id,
-                "avgCpu": avgCpu,
-                "avgMemory": avgMemory,
-                "avgDisk": avgDisk,
-                "sampleCount": len(samples)
-            }
-            headers = {"Authorization": "Bearer " + USER_TOKEN}
+    def _stream_acked(self, acked_seq):
+        latest = None
+        while self._stream_unacked and self._stream_unacked[0][0] <= acked_seq:
+            latest = self._stream_unacked.popleft()[2]
+        if latest is not None:
+            # Keep the HTTP delta baseline in step for when the stream drops.
+            # The stream carries the network totals and rates but not the
+            # interface list, so the last one sent by HTTP stays the baseline.
+            update = self.build_full_update(latest)
+            remembered = {field: update[field] for field in STREAMED_FIELDS}
+            last_network = self._realtime_state.get("network") or {}
+            remembered["network"] = dict(update["network"], interfaces=last_network.get("interfaces"))
+            self.remember_realtime_update(remembered, latest["time"])
+
+    # --- Performance Uploads ---
+    # Returns False when the aggregates should be kept for a later retry.
+    def send_performance(self, records):
+        records = [record for record in records
+                   if not self.acked.contains(record.get("bootId"), record.get("seq"))]
+        if not records:
+            return True
+        try:
+            if len(records) == 1:
+                response = self._request("performance", "POST", PERFORMANCE_URL, json=records[0])
+            else:
+                response = self._request("performance", "POST", PERFORMANCE_BULK_URL,
+                                         json={"records": records}, records=records)
+            if response.status_code in (200, 201):
+                for record in records:
+                    if record.get("seq") is not None:
+                        self.acked.add(record.get("bootId"), record["seq"])
+                print(f"Aggregated performance data sent successfully ({len(records)} record(s)).")
+                return True
+            print("Failed to send aggregated performance data:", response.status_code, response.text)
+            return not is_retryable_status(response.status_code)
+        except BackendUnavailable:
+            return False
+        except Exception as e:
+            print("Error sending aggregated performance data:", e)
+            return False
+
+    def aggregate_and_send(self):
+        while not self._stopped.is_set():
+            records = self.performance_queue.get_many(PERFORMANCE_BATCH_SIZE, QUEUE_POLL_INTERVAL)
+            if not records:
+                continue
+            # While a backlog exists, new aggregates queue up behind it so the
+            # backend still receives windows in order.
             try:
-                response = requests.post(PERFORMANCE_URL, json=aggregatedData, headers=headers)
-                if response.status_code in (200, 201):
-                    print("Aggregated performance data sent successfully.")
-                else:
-                    print("Failed to send aggregated performance data:", response.status_code, response.text)
+                if self.spool.pending() or not self.send_performance(records):
+                    self.spool.append_batch("performance", records)
             except Exception as e:
-                print("Error sending aggregated performance data:", e)
-        else:
-            print("No samples collected for aggregation.")
+                # E.g. a full disk; the loop must outlive it.
+                print(f"Could not spool {len(records)} aggregate(s), dropping them:", e)
+
+    def replay_spool(self):
+        # Any error is logged and the loop carries on: if this thread died,
+        # pending() would stay true and every new aggregate would be spooled
+        # with nothing left to deliver it.
+        replay_position = {}
+        while not self._stopped.is_set():
+            try:
+                self._replay_next_segment(replay_position)
+            except Exception as e:
+                print("Error replaying spool:", e)
+                self.clock.wait(self._stopped, RETRY_BASE_DELAY)
 
-# --- Run Both Loops Concurrently ---
-realtime_thread = threading.Thread(target=update_realtime, daemon=True)
-aggregation_thread = threading.Thread(target=aggregate_and_send, daemon=True)
+    def _replay_next_segment(self, replay_position):
+        self.spool.sync()
+        segment_id = self.spool.oldest_segment()
+        if segment_id is None:
+            self.clock.wait(self._stopped, SPOOL_RETRY_INTERVAL)
+            return
+        try:
+            records = self.spool.read_segment(segment_id)
+        except FileNotFoundError:
+            # Already gone, e.g. dropped by the size cap; nothing left to send.
+            replay_position.pop(segment_id, None)
+            return
+        position = replay_position.get(segment_id, 0)
+        while position < len(records) and not self._stopped.is_set():
+            # Send the next run of same-kind records as one batch.
+            kind = records[position][0]
+            end = position
+            while end < len(records) and end - position < PERFORMANCE_BATCH_SIZE and records[end][0] == kind:
+                end += 1
+            sender = self.spool_senders.get(kind)
+            if sender is None:
+                print(f"Spool segment {segment_id} holds {end - position} record(s) of unknown kind {kind!r}, skipping them.")
+            elif not sender([body for _, body in records[position:end]]):
+                break
+            position = end
+            self.clock.wait(self._stopped, 1.0 / SPOOL_REPLAY_RATE)
+        if position < len(records):
+            replay_position[segment_id] = position
+            if not self._stopped.is_set():
+                delay = max(self._retry_delay("performance"), RETRY_BASE_DELAY)
+                print(f"Backend unavailable, {len(records) - position} spooled record(s) pending in segment {segment_id}; retrying in {delay:.0f}s.")
+                self.clock.wait(self._stopped, delay)
+            return
+        replay_position.pop(segment_id, None)
+        self.spool.remove(segment_id)
+        print(f"Replayed spool segment {segment_id} ({len(records)} record(s)).")
+
+    # --- Token Refresh ---
+    # Tokens are renewed in the background well before they expire, so the
+    # upload loops never see a 401 in normal operation. If the token has
+    # already lapsed, fall back to a fresh login when a password is known.
+    def renew_token(self):
+        expiry = token_expiry(self.token)
+        # The server only refreshes tokens that are still valid.
+        token = refresh_token(self.transport, self.token) if expiry and expiry > self.clock.time() else None
+        if token is None and self.password:
+            token = login_and_get_token(self.transport, self.email, self.password)
+        if token is None:
+            return False
+        self.token = token
+        try:
+            save_cached_token(self.email, token)
+        except OSError as e:
+            print("Could not cache token:", e)
+        print("Authentication token renewed.")
+        return True
+
+    def refresh_token_loop(self):
+        while not self._stopped.is_set():
+            forced = self.clock.wait(self._refresh_now, TOKEN_CHECK_INTERVAL)
+            if self._stopped.is_set():
+                break
+            self._refresh_now.clear()
+            if forced or not token_is_fresh(self.token, self.clock):
+                self.renew_token()
+
+# --- Codec Benchmark ---
+# Compares the wire formats on a realistic bulk batch: the json= path that
+# requests uses for a plain session.post(), the agent's compact JSON, and the
+# sample frame, each with and without gzip, plus the spool's Gorilla blocks.
+BENCHMARK_ROUNDS = 200
+
+def benchmark_records(count=PERFORMANCE_BATCH_SIZE, vm_id="00000000-0000-0000-0000-000000000000"):
+    # One-minute rollups built from noisy synthetic samples.
+    rollups = Rollups(vm_id, ROLLUP_TIERS, "0" * 32)
+    records = []
+    now = 1700000000
+    rng = random.Random(1)
+    while len(records) < count:
+        rollups.add_sample({"time": now, "cpu": rng.uniform(0, 100),
+                            "memory": rng.uniform(40, 60), "disk": rng.uniform(70, 71),
+                            "cpu_breakdown": {"steal": rng.uniform(0, 2), "max_core": rng.uniform(50, 100)},
+                            "disk_io": {"read_bytes_per_sec": rng.uniform(0, 5e7),
+                                        "write_bytes_per_sec": rng.uniform(0, 5e7),
+                                        "iops": rng.uniform(0, 2000), "await_ms": rng.uniform(0.1, 10),
+                                        "queue_depth": rng.uniform(0, 4)}})
+        now += SAMPLE_INTERVAL
+        rollups.advance(now)
+        records.extend(rollups.tiers[1].pending)
+        rollups.tiers[1].pending = []
+    return records[:count]
+
+def _requests_json_body(payload):
+    request = requests.models.PreparedRequest()
+    request.prepare_headers(None)
+    request.prepare_body(data=None, files=None, json=payload)
+    return request.body
+
+def benchmark_codecs(records=None, rounds=BENCHMARK_ROUNDS):
+    records = records or benchmark_records()
+    payload = {"records": records}
+    codecs = [
+        ("requests json=", lambda: _requests_json_body(payload)),
+        ("compact json", lambda: json.dumps(payload, separators=(",", ":")).encode("utf-8")),
+        ("compact json+gzip", lambda: gzip.compress(
+            json.dumps(payload, separators=(",", ":")).encode("utf-8"), compresslevel=GZIP_LEVEL)),
+        ("frame", lambda: encode_frame(records)),
+        ("frame+gzip", lambda: gzip.compress(encode_frame(records), compresslevel=GZIP_LEVEL)),
+        ("gorilla (spool)", lambda: encode_columns(records)),
+    ]
+    results = []
+    print(f"Encoding {len(records)} records, {rounds} rounds each:")
+    for name, encode in codecs:
+        size = len(encode())
+        started = time.perf_counter()
+        for _ in range(rounds):
+            encode()
+        per_batch = (time.perf_counter() - started) / rounds
+        results.append((name, size, per_batch))
+        print(f"  {name:<18} {size:>8} bytes  {per_batch * 1000:8.3f} ms/batch")
+    baseline = results[0][1]
+    for name, size, _ in results[1:]:
+        print(f"  {name:<18} {baseline / size:6.2f}x smaller than requests json=")
+    return results
 
-realtime_thread.start()
-aggregation_thread.start()
+# --- Entry Point ---
+def main():
+    transport = HttpTransport()
+    config = load_config()
+    email, password = config.get("email"), config.get("password")
 
-# Keep the main thread alive.
-while True:
-    time.sleep(1)
\ No newline at end of file
+    cached_email, token = load_cached_token(email)
+    if token:
+        email = cached_email
+        print("Using cached authentication token.")
+    else:
+        if not email or not password:
+            email, password = prompt_credentials()
+        token = login_and_get_token(transport, email, password)
+        if not token:
+            exit(1)
+        if not check_user_exists(transport, email, token):
+            print("This email is not registered on the dashboard. Please register there first.")
+            exit(1)
+        else:
+            print("User found. Proceeding with monitoring...")
+        try:
+            save_cached_token(email, token)
+        except OSError as e:
+            print("Could not cache token:", e)
+
+    agent = Agent(email, token, password=password, transport=transport)
+    agent.start()
+    # Keep the main thread alive until interrupted.
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Stopping agent...")
+        agent.stop()
+
+if __name__ == "__main__":
+    if "--benchmark" in sys.argv[1:]:
+        benchmark_codecs()
+    else:
+        main()
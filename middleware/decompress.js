@@ -0,0 +1,58 @@
+// middleware/decompress.js
+// express.json() already inflates gzip/deflate JSON bodies; this handles the
+// monitoring agent's other encodings: zstd (when the Node runtime ships
+// zlib.zstdDecompress) and binary sample frames, which arrive as
+// application/vnd.vm-agent.frame and are decoded to { records: [...] }.
+const zlib = require('zlib');
+const { FRAME_CONTENT_TYPE, decodeFrame } = require('./sampleFrame');
+
+const MAX_BODY_BYTES = 4 * 1024 * 1024; // matches the express.json() limit
+
+const DECOMPRESSORS = {
+  identity: (buffer, callback) => callback(null, buffer),
+  gzip: (buffer, callback) => zlib.gunzip(buffer, { maxOutputLength: MAX_BODY_BYTES }, callback),
+  deflate: (buffer, callback) => zlib.inflate(buffer, { maxOutputLength: MAX_BODY_BYTES }, callback),
+};
+if (typeof zlib.zstdDecompress === 'function') {
+  DECOMPRESSORS.zstd = (buffer, callback) =>
+    zlib.zstdDecompress(buffer, { maxOutputLength: MAX_BODY_BYTES }, callback);
+}
+
+const decompressMiddleware = (req, res, next) => {
+  const encoding = (req.headers['content-encoding'] || 'identity').toLowerCase();
+  const framed = (req.headers['content-type'] || '').split(';')[0].trim() === FRAME_CONTENT_TYPE;
+  if (!framed && encoding !== 'zstd') return next();
+  const decompress = DECOMPRESSORS[encoding];
+  if (!decompress) {
+    return res.status(415).json({ message: `${encoding} request bodies are not supported` });
+  }
+
+  const chunks = [];
+  let received = 0;
+  req.on('data', (chunk) => {
+    received += chunk.length;
+    if (received > MAX_BODY_BYTES) {
+      res.status(413).json({ message: 'Request body too large' });
+      req.destroy();
+      return;
+    }
+    chunks.push(chunk);
+  });
+  req.on('end', () => {
+    if (res.headersSent) return;
+    decompress(Buffer.concat(chunks), (err, buffer) => {
+      if (err) return res.status(400).json({ message: `Invalid ${encoding} body` });
+      try {
+        req.body = framed ? { records: decodeFrame(buffer) } : JSON.parse(buffer.toString('utf8'));
+      } catch (parseErr) {
+        return res.status(400).json({ message: framed ? 'Invalid sample frame' : 'Invalid JSON body' });
+      }
+      // Tell express.json() the body has already been parsed.
+      req._body = true;
+      next();
+    });
+  });
+  req.on('error', next);
+};
+
+module.exports = decompressMiddleware;
@@ -0,0 +1,63 @@
+// middleware/sampleFrame.js
+// Decoder for the monitoring agent's binary sample frames (see "Binary Sample
+// Frames" in Monitoring script/vm_agent.py, which defines the layout):
+//   frame  = "VMAF", version u8, record count u16, record*
+//   record = field count u8, (field id u8, value)*
+// Field IDs must stay in step with FRAME_FIELDS in the agent.
+const FRAME_CONTENT_TYPE = 'application/vnd.vm-agent.frame';
+const FRAME_MAGIC = 'VMAF';
+const FRAME_VERSION = 1;
+
+const FRAME_FIELDS = {
+  1: ['vmId', 's'],
+  2: ['resolution', 's'],
+  3: ['timestamp', 't'],
+  4: ['sampleCount', 'I'],
+  5: ['bootId', 's'],
+  6: ['seq', 'I'],
+};
+['Cpu', 'Memory', 'Disk', 'DiskRead', 'DiskWrite', 'DiskIops', 'DiskAwait', 'DiskQueue', 'NetSent', 'NetRecv',
+  'Steal', 'CpuMaxCore'].forEach((suffix, metric) => {
+  ['avg', 'min', 'max', 'var', 'p50', 'p95', 'p99'].forEach((prefix, stat) => {
+    FRAME_FIELDS[16 + 8 * metric + stat] = [prefix + suffix, 'd'];
+  });
+});
+
+// Returns the decoded records; throws on anything malformed, including reads
+// past the end of the buffer.
+const decodeFrame = (buffer) => {
+  if (buffer.length < 7 || buffer.toString('latin1', 0, 4) !== FRAME_MAGIC) {
+    throw new Error('Not a sample frame');
+  }
+  const version = buffer.readUInt8(4);
+  if (version !== FRAME_VERSION) throw new Error(`Unsupported sample frame version ${version}`);
+  const count = buffer.readUInt16LE(5);
+  let offset = 7;
+  const records = [];
+  for (let i = 0; i < count; i++) {
+    const fields = buffer.readUInt8(offset++);
+    const record = {};
+    for (let f = 0; f < fields; f++) {
+      const field = FRAME_FIELDS[buffer.readUInt8(offset++)];
+      if (!field) throw new Error('Unknown sample frame field');
+      const [name, kind] = field;
+      if (kind === 's') {
+        const length = buffer.readUInt8(offset++);
+        if (offset + length > buffer.length) throw new RangeError('Truncated sample frame');
+        record[name] = buffer.toString('utf8', offset, offset + length);
+        offset += length;
+      } else if (kind === 'I') {
+        record[name] = buffer.readUInt32LE(offset);
+        offset += 4;
+      } else {
+        const value = buffer.readDoubleLE(offset);
+        record[name] = kind === 't' ? new Date(value).toISOString() : value;
+        offset += 8;
+      }
+    }
+    records.push(record);
+  }
+  return records;
+};
+
+module.exports = { FRAME_CONTENT_TYPE, decodeFrame };
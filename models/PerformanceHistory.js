@@ -1,14 +1,58 @@
 // models/PerformanceHistory.js
 const mongoose = require('mongoose');
 
-const PerformanceHistorySchema = new mongoose.Schema({
+const PerformanceHistoryFields = {
   vmId: { type: String, required: true },
+  // Rollup tier the record summarises ('1m', '5m', '1h'); older agents only send 5m windows
+  resolution: { type: String, default: '5m' },
   date: { type: Date, default: Date.now }, // Default to current date if not provided
   avgCpu: { type: Number, default: 0 },
   avgMemory: { type: Number, default: 0 },
   avgDisk: { type: Number, default: 0 },
+  // Spread within the window, computed on the agent from a streaming sketch
+  minCpu: Number,
+  maxCpu: Number,
+  varCpu: Number,
+  p50Cpu: Number,
+  p95Cpu: Number,
+  p99Cpu: Number,
+  minMemory: Number,
+  maxMemory: Number,
+  varMemory: Number,
+  p50Memory: Number,
+  p95Memory: Number,
+  p99Memory: Number,
+  minDisk: Number,
+  maxDisk: Number,
+  varDisk: Number,
+  p50Disk: Number,
+  p95Disk: Number,
+  p99Disk: Number,
   sampleCount: { type: Number, default: 0 },
-  timestamp: { type: Date, default: Date.now }
+  timestamp: { type: Date, default: Date.now },
+  // Record identity: the agent process that produced it and its sequence
+  // number there. Retries and spool replays resend the same pair.
+  bootId: String,
+  seq: Number
+};
+
+// Disk I/O across all block devices (bytes/s, IOPS, service time in ms,
+// queue depth), network throughput across all interfaces (bytes/s), CPU steal
+// time and the busiest core (percent), with the same statistics as the
+// metrics above.
+['DiskRead', 'DiskWrite', 'DiskIops', 'DiskAwait', 'DiskQueue', 'NetSent', 'NetRecv', 'Steal', 'CpuMaxCore'].forEach((suffix) => {
+  ['avg', 'min', 'max', 'var', 'p50', 'p95', 'p99'].forEach((prefix) => {
+    PerformanceHistoryFields[prefix + suffix] = Number;
+  });
 });
 
+const PerformanceHistorySchema = new mongoose.Schema(PerformanceHistoryFields);
+
+PerformanceHistorySchema.index({ vmId: 1, resolution: 1, timestamp: 1 });
+// Rejects redelivered records; older records without an identity are exempt.
+PerformanceHistorySchema.index(
+  { vmId: 1, bootId: 1, seq: 1 },
+  { unique: true, partialFilterExpression: { seq: { $exists: true } } }
+);
+
 module.exports = mongoose.model('PerformanceHistory', PerformanceHistorySchema);
@@ -8,11 +8,109 @@ const VMSchema = new mongoose.Schema({
   cpu: { type: Number, default: 0 },
   memory: { type: Number, default: 0 },
   disk: { type: Number, default: 0 },
+  // Time shares of all CPUs (percent; steal and irq included), each core's
+  // busy percentage and the busiest one
+  cpu_breakdown: {
+    user: Number,
+    system: Number,
+    iowait: Number,
+    irq: Number,
+    softirq: Number,
+    steal: Number,
+    max_core: Number,
+    per_core: [Number]
+  },
+  // 1, 5 and 15 minute load averages
+  load_avg: [Number],
+  // Per-second rates
+  cpu_activity: {
+    ctx_switches: Number,
+    interrupts: Number,
+    soft_interrupts: Number
+  },
+  // Cumulative counters and rates summed over all non-loopback interfaces,
+  // plus each interface's own rates
   network: {
     bytes_sent: { type: Number, default: 0 },
     bytes_recv: { type: Number, default: 0 },
     packets_sent: { type: Number, default: 0 },
-    packets_recv: { type: Number, default: 0 }
+    packets_recv: { type: Number, default: 0 },
+    errin: Number,
+    errout: Number,
+    dropin: Number,
+    dropout: Number,
+    bytes_sent_per_sec: Number,
+    bytes_recv_per_sec: Number,
+    packets_sent_per_sec: Number,
+    packets_recv_per_sec: Number,
+    errin_per_sec: Number,
+    errout_per_sec: Number,
+    dropin_per_sec: Number,
+    dropout_per_sec: Number,
+    interfaces: [{
+      _id: false,
+      name: String,
+      bytes_sent_per_sec: Number,
+      bytes_recv_per_sec: Number,
+      packets_sent_per_sec: Number,
+      packets_recv_per_sec: Number,
+      errin_per_sec: Number,
+      errout_per_sec: Number,
+      dropin_per_sec: Number,
+      dropout_per_sec: Number
+    }]
+  },
+  // Disk I/O rates summed over all block devices, plus each device's own
+  disk_io: {
+    read_bytes_per_sec: Number,
+    write_bytes_per_sec: Number,
+    iops: Number,
+    await_ms: Number,
+    queue_depth: Number,
+    devices: [{
+      _id: false,
+      device: String,
+      read_bytes_per_sec: Number,
+      write_bytes_per_sec: Number,
+      read_iops: Number,
+      write_iops: Number,
+      await_ms: Number,
+      queue_depth: Number,
+      util: Number
+    }]
+  },
+  // Capacity of every mounted filesystem; hung marks a mount whose check timed out
+  filesystems: [{
+    _id: false,
+    mount: String,
+    device: String,
+    fstype: String,
+    hung: Boolean,
+    error: String,
+    total: Number,
+    used: Number,
+    free: Number,
+    percent: Number,
+    inodes_total: Number,
+    inodes_used: Number,
+    inodes_percent: Number
+  }],
+  // TCP sockets (Linux): per-state counts, kernel totals and listen-queue
+  // overflow/drop counters; truncated marks a scan cut off at its socket cap
+  tcp: {
+    states: { type: Map, of: Number },
+    accept_queue: Number,
+    scanned: Number,
+    truncated: Boolean,
+    inuse: Number,
+    orphan: Number,
+    time_wait: Number,
+    alloc: Number,
+    mem_pages: Number,
+    listen_overflows: Number,
+    listen_drops: Number,
+    listen_overflows_per_sec: Number,
+    listen_drops_per_sec: Number
   },
   status: { type: String, default: 'Running' },
   last_updated: { type: Date, default: Date.now },
@@ -0,0 +1,187 @@
+// routes/agentStream.js
+// WebSocket endpoint for monitoring agents that stream samples instead of
+// PATCHing /api/vms every few seconds. After the upgrade (authenticated with
+// the usual Bearer token) the agent sends one JSON hello, the server answers
+// with the last sequence number it applied for that agent boot ID, and from
+// then on every sample is a fixed-size binary message (little-endian):
+//   seq u32, time f64 (epoch seconds), cpu/memory/disk f32,
+//   bytes_sent/bytes_recv/packets_sent/packets_recv f64,
+//   disk I/O read/write bytes per second, IOPS, queue depth f32,
+//   network bytes/packets sent/received per second f32 (NaN if unknown)
+// Older agents send 56-byte messages without either block, or 72-byte ones
+// without the network rates.
+// Samples are applied to the VM document in order; a reconnecting agent
+// resends what it still buffers after the announced sequence number.
+// Once a sample is stored the server answers {type: 'ack', seq}; an agent
+// that stops getting acks treats the stream as down and falls back to HTTP.
+// A failed write closes the stream (1011) so the agent resends from the
+// last stored sample, and sockets that stop answering pings are dropped.
+const WebSocket = require('ws');
+const jwt = require('jsonwebtoken');
+const VM = require('../models/VM');
+
+const STREAM_PATH = '/api/agent-stream';
+const SAMPLE_SIZES = [56, 72, 88];
+const MAX_BOOTS = 10000;
+const PING_INTERVAL = 30000;
+
+// Last stored sequence number per agent boot. The boot ID is fresh for each
+// agent process, so a restarted agent (whose numbering starts over) is not ignored.
+// Kept in memory: after a server restart agents simply resend their buffer.
+const lastSeq = new Map();
+
+const round = (value) => Math.round(value * 10) / 10;
+
+const DISK_IO_FIELDS = ['read_bytes_per_sec', 'write_bytes_per_sec', 'iops', 'queue_depth'];
+const NETWORK_RATE_FIELDS = ['bytes_sent_per_sec', 'bytes_recv_per_sec', 'packets_sent_per_sec', 'packets_recv_per_sec'];
+
+// Reads the f32 block at offset into target, skipping NaN (unknown) values.
+const readRates = (buffer, offset, fields, target) => {
+  if (buffer.length < offset + 4 * fields.length) return;
+  fields.forEach((field, i) => {
+    const value = buffer.readFloatLE(offset + 4 * i);
+    if (!Number.isNaN(value)) target[field] = round(value);
+  });
+};
+
+const decodeSample = (buffer) => {
+  const sample = {
+    seq: buffer.readUInt32LE(0),
+    time: buffer.readDoubleLE(4),
+    cpu: buffer.readFloatLE(12),
+    memory: buffer.readFloatLE(16),
+    disk: buffer.readFloatLE(20),
+    network: {
+      bytes_sent: buffer.readDoubleLE(24),
+      bytes_recv: buffer.readDoubleLE(32),
+      packets_sent: buffer.readDoubleLE(40),
+      packets_recv: buffer.readDoubleLE(48),
+    },
+    diskIo: {},
+  };
+  readRates(buffer, 56, DISK_IO_FIELDS, sample.diskIo);
+  readRates(buffer, 72, NETWORK_RATE_FIELDS, sample.network);
+  return sample;
+};
+
+const authenticate = (req) => {
+  const authHeader = req.headers.authorization;
+  if (!authHeader) return null;
+  try {
+    const decoded = jwt.verify(authHeader.split(' ')[1], process.env.JWT_SECRET);
+    return decoded.email ? decoded : null;
+  } catch (err) {
+    return null;
+  }
+};
+
+const handleConnection = (socket, user) => {
+  let agentId = null;
+  let key = null;
+  let latest = null;   // newest sample not yet written
+  let received = 0;    // newest sequence number taken on this connection
+  let writing = false;
+
+  // Bursts (e.g. a resume) are coalesced: only the newest sample is written
+  // once the previous write finishes.
+  const flush = async () => {
+    if (writing || !latest) return;
+    writing = true;
+    const sample = latest;
+    latest = null;
+    try {
+      const update = {
+        cpu: round(sample.cpu),
+        memory: round(sample.memory),
+        disk: round(sample.disk),
+        status: 'Running',
+        last_updated: new Date(sample.time * 1000),
+      };
+      // Per-device and per-interface figures arrive over HTTP; only the
+      // totals are set here, field by field so those lists are kept.
+      Object.entries(sample.network).forEach(([field, value]) => {
+        update[`network.${field}`] = value;
+      });
+      Object.entries(sample.diskIo).forEach(([field, value]) => {
+        update[`disk_io.${field}`] = value;
+      });
+      const result = await VM.updateOne({ _id: agentId, user: user.email }, { $set: update });
+      if (result.matchedCount === 0) {
+        socket.close(4404, 'VM not registered');
+      } else {
+        if (sample.seq > (lastSeq.get(key) || 0)) lastSeq.set(key, sample.seq);
+        if (socket.readyState === WebSocket.OPEN) {
+          socket.send(JSON.stringify({ type: 'ack', seq: sample.seq }));
+        }
+      }
+    } catch (error) {
+      console.error('Stream update error:', error);
+      latest = null;
+      socket.close(1011, 'Update failed');
+    }
+    writing = false;
+    flush();
+  };
+
+  socket.on('message', (data, isBinary) => {
+    // ws 7 hands text frames over as strings; ws 8 flags them with isBinary.
+    if (typeof data === 'string' || isBinary === false) {
+      let hello;
+      try {
+        hello = JSON.parse(data.toString());
+      } catch (err) {
+        return socket.close(4400, 'Invalid hello');
+      }
+      if (!hello.agentId || !hello.bootId) return socket.close(4400, 'Invalid hello');
+      agentId = String(hello.agentId);
+      key = `${agentId}:${hello.bootId}`;
+      received = 0;
+      if (!lastSeq.has(key) && lastSeq.size >= MAX_BOOTS) {
+        lastSeq.delete(lastSeq.keys().next().value);
+      }
+      socket.send(JSON.stringify({ type: 'resume', seq: lastSeq.get(key) || 0 }));
+      return;
+    }
+    if (!key) return socket.close(4400, 'Hello expected first');
+    if (!SAMPLE_SIZES.includes(data.length)) {
+      return socket.close(4400, 'Invalid sample');
+    }
+    const sample = decodeSample(data);
+    if (sample.seq <= Math.max(received, lastSeq.get(key) || 0)) return; // already taken
+    received = sample.seq;
+    latest = sample;
+    flush();
+  });
+};
+
+// Attach the endpoint to the HTTP server returned by app.listen().
+const attachAgentStream = (server) => {
+  const wss = new WebSocket.Server({ noServer: true, maxPayload: 64 * 1024 });
+  wss.on('connection', (ws) => {
+    ws.isAlive = true;
+    ws.on('pong', () => { ws.isAlive = true; });
+  });
+  const pinger = setInterval(() => {
+    wss.clients.forEach((ws) => {
+      if (!ws.isAlive) return ws.terminate();
+      ws.isAlive = false;
+      ws.ping();
+    });
+  }, PING_INTERVAL);
+  wss.on('close', () => clearInterval(pinger));
+  server.on('upgrade', (req, socket, head) => {
+    if (req.url.split('?')[0] !== STREAM_PATH) return socket.destroy();
+    const user = authenticate(req);
+    if (!user) {
+      socket.write('HTTP/1.1 401 Unauthorized\r\nConnection: close\r\n\r\n');
+      return socket.destroy();
+    }
+    wss.handleUpgrade(req, socket, head, (ws) => {
+      wss.emit('connection', ws, req);
+      handleConnection(ws, user);
+    });
+  });
+  return wss;
+};
+
+module.exports = attachAgentStream;
@@ -3,6 +3,7 @@ const express = require('express');
 const bcrypt = require('bcrypt');
 const jwt = require('jsonwebtoken');
 const User = require('../models/User');
+const authMiddleware = require('../middleware/auth');
 
 const router = express.Router();
 
@@ -46,4 +47,12 @@ router.post('/login', async (req, res) => {
   }
 });
 
+// Refresh endpoint: exchange a still-valid token for a new one so long-running
+// agents can keep reporting without storing or re-sending the password.
+router.post('/refresh', authMiddleware, (req, res) => {
+  const { id, email } = req.user;
+  const token = jwt.sign({ id, email }, process.env.JWT_SECRET, { expiresIn: '1h' });
+  res.json({ token, userId: id, email });
+});
+
 module.exports = router;
@@ -5,29 +5,79 @@ const authMiddleware = require('../middleware/auth');
 
 router.use(authMiddleware);
 
+// Duplicate key errors from the { vmId, bootId, seq } index mean the record
+// was already stored by an earlier delivery attempt.
+const isDuplicateKey = (error) => error && error.code === 11000;
+
 // POST aggregated performance data
 router.post('/', async (req, res) => {
   const performanceData = req.body;
-  // Add a timestamp if needed
-  performanceData.timestamp = new Date();
+  // Keep the agent's window timestamp so replayed data lands where it belongs;
+  // fall back to the receive time for older agents that don't send one.
+  performanceData.timestamp = performanceData.timestamp ? new Date(performanceData.timestamp) : new Date();
   try {
     const entry = await PerformanceHistory.create(performanceData);
     res.status(201).json({ message: 'Performance history saved', entry });
   } catch (error) {
+    if (isDuplicateKey(error)) {
+      return res.status(200).json({ message: 'Performance history already saved', duplicates: 1 });
+    }
     console.error('Error saving performance data:', error);
     res.status(500).json({ message: 'Error saving performance data', error: error.toString() });
   }
 });
 
-// GET /api/performance/history?vmId=<id>&startDate=<ISO>&endDate=<ISO>
+// POST a batch of aggregated performance records in a single bulk write.
+// Body: { records: [{ vmId, bootId, seq, avgCpu, avgMemory, avgDisk, sampleCount, timestamp }, ...] }
+// Records already stored under the same { vmId, bootId, seq } are skipped,
+// so a retried or replayed batch is safe to send again.
+// Agents may also send the records as a binary sample frame; middleware/decompress.js
+// decodes it into the same shape before this handler runs.
+const MAX_BULK_RECORDS = 500;
+
+router.post('/bulk', async (req, res) => {
+  const records = Array.isArray(req.body) ? req.body : req.body.records;
+  if (!Array.isArray(records) || records.length === 0) {
+    return res.status(400).json({ message: 'Expected a non-empty records array.' });
+  }
+  if (records.length > MAX_BULK_RECORDS) {
+    return res.status(413).json({ message: `At most ${MAX_BULK_RECORDS} records per request.` });
+  }
+  const receivedAt = new Date();
+  const docs = records.map((record) => ({
+    ...record,
+    timestamp: record.timestamp ? new Date(record.timestamp) : receivedAt,
+  }));
+  try {
+    const entries = await PerformanceHistory.insertMany(docs, { ordered: false });
+    res.status(201).json({ message: 'Performance history saved', inserted: entries.length, duplicates: 0 });
+  } catch (error) {
+    // With ordered: false every other record is still inserted; if only
+    // redelivered records failed, the batch as a whole is stored.
+    const writeErrors = (error && error.writeErrors) || [];
+    if (writeErrors.length > 0 && writeErrors.every(isDuplicateKey)) {
+      return res.status(201).json({
+        message: 'Performance history saved',
+        inserted: docs.length - writeErrors.length,
+        duplicates: writeErrors.length,
+      });
+    }
+    console.error('Error saving performance data batch:', error);
+    res.status(500).json({ message: 'Error saving performance data', error: error.toString() });
+  }
+});
+
+// GET /api/performance/history?vmId=<id>&startDate=<ISO>&endDate=<ISO>[&resolution=1m|5m|1h]
 router.get('/history', async (req, res) => {
-  const { vmId, startDate, endDate } = req.query;
+  const { vmId, startDate, endDate, resolution = '5m' } = req.query;
   if (!vmId || !startDate || !endDate) {
     return res.status(400).json({ message: 'Missing vmId, startDate, or endDate in query parameters.' });
   }
   try {
     const history = await PerformanceHistory.find({
       vmId,
+      // Records written before rollups existed have no resolution and are 5m windows.
+      resolution: resolution === '5m' ? { $in: ['5m', null] } : resolution,
       timestamp: { $gte: new Date(startDate), $lte: new Date(endDate) }
     }).sort({ timestamp: 1 });
     res.status(200).json(history);
@@ -43,23 +43,61 @@ router.post('/', async (req, res) => {
 
 // PUT update a VM by ID (only if it belongs to the user)
 // Remove the user field from the update data so it cannot be changed.
+// With ?upsert=true the VM is created if missing, so an agent can register
+// and update in a single idempotent request.
 router.put('/:id', async (req, res) => {
+  const upsert = req.query.upsert === 'true';
   try {
     const updateData = { ...req.body };
     delete updateData.user;
+    delete updateData._id;
     const updatedVM = await VM.findOneAndUpdate(
       { _id: req.params.id, user: req.user.email },
       updateData,
-      { new: true }
+      { new: true, upsert, setDefaultsOnInsert: true, runValidators: upsert }
     );
     if (!updatedVM) return res.status(404).json({ error: 'VM not found' });
     res.json(updatedVM);
   } catch (error) {
+    if (error.code === 11000) {
+      // The ID is already registered to a different user.
+      return res.status(409).json({ error: 'VM ID belongs to another user' });
+    }
     console.error("Update error:", error);
     res.status(500).json({ message: 'Error updating VM' });
   }
 });
 
+// PATCH only the supplied fields of a VM (delta updates from the agent).
+// Nested objects are flattened to dotted paths so a partial update never
+// clears sibling fields, and no document is sent back.
+const flattenUpdate = (data, prefix = '', out = {}) => {
+  Object.entries(data).forEach(([key, value]) => {
+    const path = prefix + key;
+    if (value && typeof value === 'object' && !Array.isArray(value)) {
+      flattenUpdate(value, `${path}.`, out);
+    } else {
+      out[path] = value;
+    }
+  });
+  return out;
+};
+
+router.patch('/:id', async (req, res) => {
+  try {
+    const { user, _id, ...fields } = req.body;
+    const result = await VM.updateOne(
+      { _id: req.params.id, user: req.user.email },
+      { $set: flattenUpdate(fields) }
+    );
+    if (result.matchedCount === 0) return res.status(404).json({ error: 'VM not found' });
+    res.status(204).end();
+  } catch (error) {
+    console.error("Patch error:", error);
+    res.status(500).json({ message: 'Error updating VM' });
+  }
+});
+
 // DELETE a VM by ID (only if it belongs to the user)
 router.delete('/:id', async (req, res) => {
   try {
@@ -13,7 +13,8 @@ mongoose.connect(process.env.MONGODB_URI)
   .catch((err) => console.error('MongoDB connection error:', err));
 
 app.use(cors());
-app.use(express.json());
+app.use(require('./middleware/decompress')); // zstd agent uploads; gzip is handled by express.json
+app.use(express.json({ limit: '4mb' })); // a full bulk batch of performance records is close to 1mb
 
 // Import routes
 const authRouter = require('./routes/auth');
@@ -36,6 +37,9 @@ app.get('*', (req, res) => {
   res.sendFile(path.join(__dirname, 'build', 'index.html'));
 });
 
-app.listen(PORT, () => {
+const server = app.listen(PORT, () => {
   console.log(`Server is running on port ${PORT}`);
 });
+
+// Agents in streaming mode push samples over a WebSocket on the same port.
+require('./routes/agentStream')(server);
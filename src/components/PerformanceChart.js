@@ -55,12 +55,21 @@ function PerformanceChart() {
     setSelectedVmIds(ids);
   }, [selectedOptions]);
 
+  // Pick the coarsest rollup that still gives a useful number of points for the range.
+  const pickResolution = (start, end) => {
+    const hours = (end - start) / (60 * 60 * 1000);
+    if (hours > 48) return '1h';
+    if (hours > 6) return '5m';
+    return '1m';
+  };
+
   // Fetch historical performance history from MongoDB for each selected VM.
   useEffect(() => {
     if (selectedVmIds.length === 0) return;
+    const resolution = pickResolution(startDate, endDate);
     const fetchHistoricalForVm = async (id) => {
       try {
-        const url = `${process.env.REACT_APP_API_URL || 'https://capstone-ctfhh0dvb6ehaxaw.canadacentral-01.azurewebsites.net'}/api/performance/history?vmId=${id}&startDate=${startDate.toISOString()}&endDate=${endDate.toISOString()}`;
+        const url = `${process.env.REACT_APP_API_URL || 'https://capstone-ctfhh0dvb6ehaxaw.canadacentral-01.azurewebsites.net'}/api/performance/history?vmId=${id}&startDate=${startDate.toISOString()}&endDate=${endDate.toISOString()}&resolution=${resolution}`;
         const res = await fetch(url, { headers });
         if (res.ok) {
           const data = await res.json();